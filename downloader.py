@@ -0,0 +1,270 @@
+import os
+import hashlib
+import asyncio
+import logging
+import aiohttp
+import aiofiles
+from pathlib import Path
+
+logger = logging.getLogger("vkd")
+
+# Сколько файлов качаем одновременно
+DOWNLOAD_WORKERS = 16
+# Сколько соединений держим к одному хосту CDN, чтобы он не рвал соединения
+CONNECTIONS_PER_HOST = 8
+# Размер куска при потоковой записи на диск
+CHUNK_SIZE = 256 * 1024
+# Суффикс временного файла, в который идет загрузка до атомарного переименования
+PART_SUFFIX = ".part"
+# Большие файлы (видео) качаются несколькими параллельными запросами Range
+RANGE_SEGMENTS = 4
+# Файлы меньше этого размера на сегменты не делятся
+MIN_SEGMENT_SIZE = 4 * 1024 * 1024
+SEGMENT_RETRIES = 3
+
+
+def make_session(workers: int = DOWNLOAD_WORKERS, per_host: int = CONNECTIONS_PER_HOST) -> aiohttp.ClientSession:
+    'Сессия для загрузки файлов: общий лимит соединений и лимит на каждый хост'
+    connector = aiohttp.TCPConnector(limit=workers, limit_per_host=per_host)
+    return aiohttp.ClientSession(
+        connector=connector,
+        # без сжатия размер тела совпадает с Content-Length и Range считаются в байтах файла
+        headers={"Accept-Encoding": "identity"},
+        timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+    )
+
+
+async def stream_to_file(response: aiohttp.ClientResponse, path: Path, mode: str = "wb", hasher=None) -> int:
+    '''Пишет тело ответа на диск кусками по CHUNK_SIZE, в памяти не больше одного куска.
+    Если передан hasher, содержимое хешируется по ходу записи'''
+    written = 0
+    async with aiofiles.open(path, mode) as f:
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            await f.write(chunk)
+            if hasher is not None:
+                hasher.update(chunk)
+            written += len(chunk)
+    return written
+
+
+def _hash_prefix(path: Path, hasher):
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            hasher.update(chunk)
+
+
+def part_path(path: Path) -> Path:
+    return path.with_name(path.name + PART_SUFFIX)
+
+
+async def remote_info(session: aiohttp.ClientSession, url: str) -> tuple[int | None, bool]:
+    '''Размер файла на сервере по Content-Length из HEAD (None, если сервер его не сообщил)
+    и поддержка запросов Range'''
+    async with session.head(url, allow_redirects=True) as response:
+        if response.status != 200:
+            return None, False
+        return response.content_length, response.headers.get("Accept-Ranges", "").lower() == "bytes"
+
+
+def _total_from_content_range(value: str | None) -> int | None:
+    # Content-Range: bytes 100-199/200 или bytes */200
+    if not value or "/" not in value:
+        return None
+    total = value.rsplit("/", 1)[1]
+    return int(total) if total.isdigit() else None
+
+
+def _finish(part: Path, path: Path, digest: str | None, store=None):
+    'Переносит полный .part на место: в хранилище по содержимому, если оно включено, иначе прямо в path'
+    if store is None:
+        os.replace(part, path)
+        return
+    if digest is None:
+        hasher = hashlib.sha1()
+        _hash_prefix(part, hasher)
+        digest = hasher.hexdigest()
+    store.ingest(part, digest, path)
+
+
+async def download_file(session: aiohttp.ClientSession, url: str, path: Path, store=None) -> dict | None:
+    '''Скачивает url в path. Загрузка идет во временный файл path.part, который
+    переименовывается в path только целиком скачанным. Если .part остался от прерванного запуска,
+    загрузка продолжается запросом Range. Уже существующий path сверяется с Content-Length
+    и докачивается, если он обрезан.
+    Возвращает {"path", "size", "sha1"} если path на диске полный, иначе None.
+    sha1 считается по ходу загрузки и равен None, если файл уже был на диске.
+    С store (storage.ContentStore) файл кладется в хранилище под своим sha1, а в path ставится ссылка.'''
+    part = part_path(path)
+    if path.exists():
+        expected, _ = await remote_info(session, url)
+        stat = path.stat()
+        size = stat.st_size
+        if expected is None or expected == size:
+            logger.debug(f"Пропущено (уже существует): {path.name}")
+            return {"path": path, "size": size, "sha1": None}
+        logger.warning(f"Файл {path.name} поврежден: {size} байт вместо {expected}, докачиваем")
+        # ссылка на объект хранилища (или иную общую копию) докачивается только заново:
+        # дописывание в нее изменило бы файл во всех папках, где он связан
+        shared = store is not None or stat.st_nlink > 1
+        if size < expected and not part.exists() and not shared:
+            os.replace(path, part)
+        else:
+            path.unlink()
+
+    offset = part.stat().st_size if part.exists() else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else None
+    async with session.get(url, headers=headers) as response:
+        if response.status == 416:
+            # запрошенный диапазон за концом файла: .part уже полный, если совпал размер
+            total = _total_from_content_range(response.headers.get("Content-Range"))
+            if total is not None and total == offset:
+                await asyncio.to_thread(_finish, part, path, None, store)
+                return {"path": path, "size": total, "sha1": None}
+            part.unlink(missing_ok=True)
+            logger.warning(f"Не удалось докачать {path.name}, начнем заново при следующем запуске")
+            return None
+        hasher = hashlib.sha1()
+        if response.status == 206 and offset:
+            mode = "ab"
+            expected = _total_from_content_range(response.headers.get("Content-Range"))
+            # уже скачанное начало файла тоже должно попасть в хеш
+            await asyncio.to_thread(_hash_prefix, part, hasher)
+        elif response.status == 200:
+            # сервер не поддержал Range: качаем с начала
+            mode, offset = "wb", 0
+            expected = response.content_length
+        else:
+            logger.error(f"Ошибка загрузки {url}: HTTP {response.status}")
+            return None
+        await stream_to_file(response, part, mode, hasher)
+
+    size = part.stat().st_size
+    if expected is not None and size != expected:
+        # .part оставляем: при следующем запуске загрузка продолжится с этого места
+        logger.warning(f"Загрузка {path.name} прервана: {size} из {expected} байт")
+        return None
+    digest = hasher.hexdigest()
+    await asyncio.to_thread(_finish, part, path, digest, store)
+    return {"path": path, "size": size, "sha1": digest}
+
+
+def best_mp4_url(files: dict | None) -> str | None:
+    'Ссылка на mp4 лучшего качества из поля files ответа video.get (mp4_240 ... mp4_2160)'
+    best, best_url = 0, None
+    for key, url in (files or {}).items():
+        quality = key.removeprefix("mp4_")
+        if key.startswith("mp4_") and quality.isdigit() and url and int(quality) > best:
+            best, best_url = int(quality), url
+    return best_url
+
+
+def _preallocate(path: Path, size: int):
+    with open(path, "wb") as f:
+        if hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(f.fileno(), 0, size)
+        else:
+            f.truncate(size)
+
+
+async def _fetch_segment(session: aiohttp.ClientSession, url: str, path: Path, start: int, end: int):
+    'Скачивает байты start..end включительно в то же место предвыделенного файла, с докачкой при обрыве'
+    position = start
+    for attempt in range(SEGMENT_RETRIES + 1):
+        try:
+            async with session.get(url, headers={"Range": f"bytes={position}-{end}"}) as response:
+                if response.status != 206:
+                    raise aiohttp.ClientResponseError(
+                        response.request_info, response.history, status=response.status,
+                        message="сервер не отдал запрошенный диапазон"
+                    )
+                async with aiofiles.open(path, "r+b") as f:
+                    await f.seek(position)
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        data = chunk[:end + 1 - position]
+                        await f.write(data)
+                        position += len(data)
+                        if position > end:
+                            break
+            if position > end:
+                return
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == SEGMENT_RETRIES:
+                raise
+            logger.debug(f"Сегмент {start}-{end} {path.name} прерван на {position}: {e}, повтор")
+        await asyncio.sleep(min(2 ** attempt, 10))
+    raise IOError(f"Сегмент {start}-{end} {path.name} не докачан")
+
+
+async def download_ranged(session: aiohttp.ClientSession, url: str, path: Path, segments: int = RANGE_SEGMENTS) -> dict | None:
+    '''Скачивает большой файл несколькими параллельными запросами Range в предвыделенный path.part.
+    Если сервер не сообщает размер или не поддерживает Range, или файл небольшой, качает одним потоком
+    через download_file. Возвращает {"path", "size", "sha1"} как download_file, sha1 здесь не считается
+    (сегменты приходят не по порядку).'''
+    size, accepts_ranges = await remote_info(session, url)
+    if path.exists() and size is not None and path.stat().st_size == size:
+        logger.debug(f"Пропущено (уже существует): {path.name}")
+        return {"path": path, "size": size, "sha1": None}
+    if not size or not accepts_ranges or size < MIN_SEGMENT_SIZE * 2:
+        return await download_file(session, url, path)
+
+    segments = max(1, min(segments, size // MIN_SEGMENT_SIZE))
+    step = -(-size // segments)
+    part = part_path(path)
+    # сегменты не запоминают прогресс между запусками: .part от прошлого раза перезаписывается
+    await asyncio.to_thread(_preallocate, part, size)
+    try:
+        await asyncio.gather(*(
+            _fetch_segment(session, url, part, start, min(start + step, size) - 1)
+            for start in range(0, size, step)
+        ))
+    except Exception:
+        part.unlink(missing_ok=True)
+        raise
+    os.replace(part, path)
+    return {"path": path, "size": size, "sha1": None}
+
+
+class DownloadPool:
+    '''Пул из workers воркеров над ограниченной очередью заданий.
+    handler(job) — корутина, которая обрабатывает одно задание. put() ждет, если очередь полна,
+    поэтому тот, кто кладет задания, не убегает вперед загрузки.'''
+    def __init__(self, handler, workers: int = DOWNLOAD_WORKERS, queue_size: int | None = None, progress=None):
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.queue = asyncio.Queue(maxsize=queue_size or self.workers * 4)
+        self.progress = progress
+        self._tasks = []
+
+    async def __aenter__(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            return
+        # сигнал воркерам, что заданий больше не будет
+        for _ in self._tasks:
+            await self.queue.put(None)
+        await asyncio.gather(*self._tasks)
+
+    async def put(self, job):
+        await self.queue.put(job)
+
+    async def _worker(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                if job is None:
+                    return
+                await self.handler(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка при обработке задания {job}: {e}")
+            finally:
+                if job is not None and self.progress is not None:
+                    self.progress.update(1)
+                self.queue.task_done()
@@ -1,11 +1,22 @@
 #!/usr/bin/env python
-# if running in py3, change the shebang, drop the next import for readability (it does no harm in py3)
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sqlite3
 import hashlib
 from pathlib import Path
 
+# persistent hash cache, lives in the root of the scanned directory
+HASH_CACHE_NAME = ".vkd_hashes.sqlite3"
+# size of the head that is hashed before deciding to hash the whole file
+HEAD_SIZE = 1024
+# read buffer for full hashes
+CHUNK_SIZE = 1024 * 1024
+# hashlib releases the GIL on large buffers, so threads scale across cores
+HASH_WORKERS = min(8, os.cpu_count() or 1)
 
-def chunk_reader(fobj, chunk_size=1024):
+
+def chunk_reader(fobj, chunk_size=CHUNK_SIZE):
     """Generator that reads a file in chunks of bytes"""
     while True:
         chunk = fobj.read(chunk_size)
@@ -15,60 +26,127 @@ def chunk_reader(fobj, chunk_size=1024):
 
 
 def get_hash(filename: Path, first_chunk_only=False, hash=hashlib.sha1):
-    hashobj = hash()
     with open(filename, "rb") as file_object:
         if first_chunk_only:
-            hashobj.update(file_object.read(1024))
+            hashobj = hash()
+            hashobj.update(file_object.read(HEAD_SIZE))
+            return hashobj.digest()
+        hashobj = hash()
+        for chunk in chunk_reader(file_object):
+            hashobj.update(chunk)
+        return hashobj.digest()
+
+
+class HashCache:
+    """(path, size, mtime) -> head and full hashes. A file is re-read only when it is new or changed."""
+    def __init__(self, db_path: Path):
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS hashes (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                head BLOB,
+                full BLOB
+            )
+        """)
+        self.rows = {
+            path: (size, mtime_ns, head, full)
+            for path, size, mtime_ns, head, full in self.conn.execute("SELECT path, size, mtime_ns, head, full FROM hashes")
+        }
+
+    def get(self, path: Path, stat, kind: str):
+        row = self.rows.get(str(path))
+        if row is None or row[0] != stat.st_size or row[1] != stat.st_mtime_ns:
+            return None
+        return row[2] if kind == "head" else row[3]
+
+    def put(self, path: Path, stat, head=None, full=None):
+        row = self.rows.get(str(path))
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            head = head or row[2]
+            full = full or row[3]
+        self.rows[str(path)] = (stat.st_size, stat.st_mtime_ns, head, full)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO hashes (path, size, mtime_ns, head, full) VALUES (?, ?, ?, ?, ?)",
+            (str(path), stat.st_size, stat.st_mtime_ns, head, full)
+        )
+
+    def prune(self, alive: set[str]):
+        # forget files that were deleted or moved since the last run
+        gone = [path for path in self.rows if path not in alive]
+        for path in gone:
+            del self.rows[path]
+        self.conn.executemany("DELETE FROM hashes WHERE path = ?", ((path,) for path in gone))
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+def scan_files(path: Path, pattern: str = "*.jpg"):
+    """Recursive walk: per-album subdirectories are scanned too"""
+    for file_path in sorted(path.rglob(pattern)):
+        if file_path.is_file() and not file_path.is_symlink():
+            yield file_path, file_path.stat()
+
+
+def _cached_hashes(files, cache: HashCache, kind: str, executor: ThreadPoolExecutor) -> dict:
+    """Hash of every (path, stat) in files, reading from disk only what the cache does not have"""
+    result = {}
+    missing = []
+    for file_path, stat in files:
+        cached = cache.get(file_path, stat, kind)
+        if cached is not None:
+            result[file_path] = cached
         else:
-            for chunk in chunk_reader(file_object):
-                hashobj.update(chunk)
-        hashed = hashobj.digest()
-
-        return hashed
+            missing.append((file_path, stat))
+    first_chunk_only = kind == "head"
+    hashed = executor.map(lambda item: get_hash(item[0], first_chunk_only=first_chunk_only), missing)
+    for (file_path, stat), digest in zip(missing, hashed):
+        result[file_path] = digest
+        cache.put(file_path, stat, **{kind: digest})
+    return result
 
 
-def check_for_duplicates(path: Path) -> int:
+def check_for_duplicates(path: Path, pattern: str = "*.jpg") -> int:
     if not path: # на всякий случай
         return 0
-    hashes_by_size = defaultdict(list)  # dict of size_in_bytes: [full_path_to_file1, full_path_to_file2, ]
-    hashes_on_1k = defaultdict(list)  # dict of (hash1k, size_in_bytes): [full_path_to_file1, full_path_to_file2, ]
-    hashes_full = {}   # dict of full_file_hash: full_path_to_file_string
-    files = path.glob("*.jpg")
-
-    for file_path in files:
-        # if the target is a symlink (soft one), this will
-        # dereference it - change the value to the actual target file
-        file_size = file_path.stat().st_size
-        hashes_by_size[file_size].append(file_path)
-
-
-    # For all files with the same file size, get their hash on the 1st 1024 bytes only
-    for size_in_bytes, files in hashes_by_size.items():
-        if len(files) < 2:
-            continue    # this file size is unique, no need to spend CPU cycles on it
-
-        for filename in files:
-            small_hash = get_hash(filename, first_chunk_only=True)
-            # the key is the hash on the first 1024 bytes plus the size - to
-            # avoid collisions on equal hashes in the first part of the file
-            hashes_on_1k[(small_hash, size_in_bytes)].append(filename)
-
-    duplicates = []
-
-    # For all files with the hash on the 1st 1024 bytes, get their hash on the full file - collisions will be duplicates
-    for __, files_list in hashes_on_1k.items():
-        if len(files_list) < 2:
-            continue    # this hash of fist 1k file bytes is unique, no need to spend cpy cycles on it
-
-        for filename in files_list:
-            full_hash = get_hash(filename, first_chunk_only=False)
-            duplicate = hashes_full.get(full_hash)
-            if duplicate:
-                duplicates.append(filename)
+    cache = HashCache(path / HASH_CACHE_NAME)
+    try:
+        hashes_by_size = defaultdict(list)  # dict of size_in_bytes: [(path, stat), ...]
+        alive = set()
+        for file_path, stat in scan_files(path, pattern):
+            hashes_by_size[stat.st_size].append((file_path, stat))
+            alive.add(str(file_path))
+        cache.prune(alive)
+
+        with ThreadPoolExecutor(max_workers=HASH_WORKERS) as executor:
+            # For all files with the same file size, get their hash on the first HEAD_SIZE bytes only
+            hashes_on_head = defaultdict(list)  # dict of (head_hash, size_in_bytes): [(path, stat), ...]
+            candidates = [item for files in hashes_by_size.values() if len(files) > 1 for item in files]
+            heads = _cached_hashes(candidates, cache, "head", executor)
+            for file_path, stat in candidates:
+                # the key is the head hash plus the size - to avoid collisions on equal heads
+                hashes_on_head[(heads[file_path], stat.st_size)].append((file_path, stat))
+
+            # For all files with the same head, get their hash on the full file - collisions will be duplicates
+            candidates = [item for files in hashes_on_head.values() if len(files) > 1 for item in files]
+            fulls = _cached_hashes(candidates, cache, "full", executor)
+
+        hashes_full = {}   # dict of full_file_hash: path
+        duplicates = []
+        for file_path, _ in candidates:
+            full_hash = fulls[file_path]
+            if full_hash in hashes_full:
+                duplicates.append(file_path)
             else:
-                hashes_full[full_hash] = filename
+                hashes_full[full_hash] = file_path
 
-    for file in duplicates:
-        file.unlink()
+        for file in duplicates:
+            file.unlink()
+        cache.prune(alive - {str(file) for file in duplicates})
+    finally:
+        cache.close()
 
-    return len(duplicates)
\ No newline at end of file
+    return len(duplicates)
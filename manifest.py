@@ -0,0 +1,171 @@
+import os
+import time
+import json
+import sqlite3
+import logging
+from pathlib import Path
+
+logger = logging.getLogger("vkd")
+
+# Файл базы лежит в корне папки загрузок, вместе с архивом
+MANIFEST_NAME = ".vkd_manifest.sqlite3"
+
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+# Коммитим не каждую запись, а пачками
+COMMIT_EVERY = 200
+
+
+class Manifest:
+    '''Локальная база загрузок. Ключ — (owner_id, media_type, id), хранит url, путь на диске,
+    размер, хеш содержимого и статус. По ней загрузчики одним запросом узнают,
+    что уже скачано, вместо проверки каждого файла на диске, и повторяют упавшие загрузки.'''
+    def __init__(self, db_path: Path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(self.db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS items (
+                owner_id INTEGER NOT NULL,
+                media_type TEXT NOT NULL,
+                id INTEGER NOT NULL,
+                url TEXT,
+                path TEXT,
+                size INTEGER,
+                sha1 TEXT,
+                status TEXT NOT NULL,
+                error TEXT,
+                updated REAL,
+                PRIMARY KEY (owner_id, media_type, id)
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS items_status ON items (media_type, status)")
+        # водяные знаки инкрементальной синхронизации: самый новый пост стены / сообщение чата
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS watermarks (
+                owner_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                last_id INTEGER,
+                last_date INTEGER,
+                updated REAL,
+                PRIMARY KEY (owner_id, kind)
+            )
+        """)
+        # кеш ответов апи, которые редко меняются (id, имена, названия), с временем записи для TTL
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS cache (
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                updated REAL,
+                PRIMARY KEY (kind, key)
+            )
+        """)
+        self.conn.commit()
+        self._uncommitted = 0
+
+    def done_paths(self, media_type: str, owner_ids=None) -> dict[tuple[int, int], str]:
+        'Все скачанные элементы одним запросом: (owner_id, id) -> путь'
+        query = "SELECT owner_id, id, path FROM items WHERE media_type = ? AND status = ?"
+        params = [media_type, STATUS_DONE]
+        if owner_ids is not None:
+            owner_ids = list(owner_ids)
+            query += f" AND owner_id IN ({','.join('?' * len(owner_ids))})"
+            params.extend(owner_ids)
+        return {(owner_id, id): path for owner_id, id, path in self.conn.execute(query, params)}
+
+    def failed_items(self, media_type: str, owner_ids=None, directories=None) -> list[dict]:
+        '''Элементы, загрузка которых упала в прошлых запусках.
+        directories — только те, чей путь лежит внутри одной из этих папок'''
+        query = "SELECT owner_id, id, url, path FROM items WHERE media_type = ? AND status = ?"
+        params = [media_type, STATUS_FAILED]
+        if owner_ids is not None:
+            owner_ids = list(owner_ids)
+            query += f" AND owner_id IN ({','.join('?' * len(owner_ids))})"
+            params.extend(owner_ids)
+        if directories is not None:
+            prefixes = [os.path.join(str(Path(directory).resolve()), "") for directory in directories]
+            if not prefixes:
+                return []
+            # сравниваем префикс через substr, а не LIKE: % и _ в названиях папок не должны быть шаблоном
+            query += f" AND ({' OR '.join('substr(path, 1, ?) = ?' for _ in prefixes)})"
+            for prefix in prefixes:
+                params.extend((len(prefix), prefix))
+        return [
+            {"owner_id": owner_id, "id": id, "url": url, "path": path}
+            for owner_id, id, url, path in self.conn.execute(query, params)
+        ]
+
+    def _upsert(self, owner_id, media_type, id, url, path, size, sha1, status, error=None):
+        self.conn.execute("""
+            INSERT INTO items (owner_id, media_type, id, url, path, size, sha1, status, error, updated)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (owner_id, media_type, id) DO UPDATE SET
+                url = excluded.url,
+                path = excluded.path,
+                size = COALESCE(excluded.size, items.size),
+                sha1 = COALESCE(excluded.sha1, items.sha1),
+                status = excluded.status,
+                error = excluded.error,
+                updated = excluded.updated
+        """, (owner_id, media_type, id, url, str(path) if path else None, size, sha1, status, error, time.time()))
+        self._uncommitted += 1
+        if self._uncommitted >= COMMIT_EVERY:
+            self.commit()
+
+    def mark_done(self, owner_id, media_type, id, url, path, size=None, sha1=None):
+        self._upsert(owner_id, media_type, id, url, path, size, sha1, STATUS_DONE)
+
+    def mark_failed(self, owner_id, media_type, id, url, path, error=None):
+        self._upsert(owner_id, media_type, id, url, path, None, None, STATUS_FAILED, error)
+
+    def get_watermark(self, owner_id, kind: str) -> dict | None:
+        row = self.conn.execute(
+            "SELECT last_id, last_date FROM watermarks WHERE owner_id = ? AND kind = ?", (owner_id, kind)
+        ).fetchone()
+        if row is None:
+            return None
+        return {"last_id": row[0], "last_date": row[1]}
+
+    def set_watermark(self, owner_id, kind: str, last_id, last_date=None):
+        self.conn.execute("""
+            INSERT INTO watermarks (owner_id, kind, last_id, last_date, updated) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (owner_id, kind) DO UPDATE SET
+                last_id = MAX(excluded.last_id, watermarks.last_id),
+                last_date = MAX(COALESCE(excluded.last_date, 0), COALESCE(watermarks.last_date, 0)),
+                updated = excluded.updated
+        """, (owner_id, kind, last_id, last_date, time.time()))
+        self.commit()
+
+    def cache_get(self, kind: str, keys, ttl: float) -> dict:
+        'Записи кеша kind не старше ttl секунд: key -> значение'
+        keys = [str(key) for key in keys]
+        result = {}
+        # SQLite ограничивает число параметров в запросе
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows = self.conn.execute(
+                f"SELECT key, value FROM cache WHERE kind = ? AND updated >= ? AND key IN ({','.join('?' * len(chunk))})",
+                [kind, time.time() - ttl, *chunk]
+            )
+            result.update((key, json.loads(value)) for key, value in rows)
+        return result
+
+    def cache_put(self, kind: str, items: dict):
+        now = time.time()
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO cache (kind, key, value, updated) VALUES (?, ?, ?, ?)",
+            [(kind, str(key), json.dumps(value, ensure_ascii=False), now) for key, value in items.items()]
+        )
+        self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self._uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
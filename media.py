@@ -0,0 +1,74 @@
+from datetime import datetime
+
+# Дата в именах файлов
+DATE_FORMAT = '%Y-%m-%d %H-%M-%S'
+
+
+def format_date(timestamp) -> str:
+    return datetime.fromtimestamp(int(timestamp or 0)).strftime(DATE_FORMAT)
+
+
+def largest_size_url(sizes) -> str | None:
+    'Ссылка на самый большой размер фото: апи отдает sizes по возрастанию'
+    if sizes and isinstance(sizes[-1], dict):
+        return sizes[-1].get("url")
+    return None
+
+
+class MediaItem:
+    '''Компактная запись о медиафайле: только поля, нужные для загрузки, без сырого json апи.
+    На __slots__ нет словаря на каждый объект, а дата хранится числом и форматируется
+    только когда нужна для имени файла. Поддерживает доступ как к словарю (item["url"], item.get()),
+    поэтому загрузчики одинаково работают и с ней, и со словарями из манифеста'''
+    __slots__ = ("owner_id", "id", "timestamp", "url", "type", "album_id", "album_title", "title", "player", "files")
+
+    def __init__(self, owner_id, id, timestamp=0, url=None, type=None, album_id=None, album_title=None,
+                 title=None, player=None, files=None):
+        self.owner_id = owner_id
+        self.id = id
+        self.timestamp = timestamp
+        self.url = url
+        self.type = type
+        self.album_id = album_id
+        self.album_title = album_title
+        self.title = title
+        self.player = player
+        self.files = files
+
+    @classmethod
+    def from_photo(cls, photo: dict, albums_dict: dict | None = None, type=None) -> "MediaItem":
+        album_id = photo.get("album_id")
+        return cls(
+            photo.get("owner_id"), photo.get("id"), photo.get("date", 0),
+            url=largest_size_url(photo.get("sizes")),
+            type=type,
+            album_id=album_id,
+            album_title=albums_dict.get(album_id, "Без альбома") if albums_dict is not None else None,
+        )
+
+    @classmethod
+    def from_video(cls, video: dict) -> "MediaItem":
+        return cls(
+            video.get("owner_id"), video.get("id"), video.get("date", 0),
+            type=video.get("type"),
+            title=video.get("title"),
+            player=video.get("player"),
+            # прямые ссылки на mp4 по качествам, если апи их отдал: качаются без yt-dlp
+            files=video.get("files"),
+        )
+
+    @property
+    def date(self) -> str:
+        return format_date(self.timestamp)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def __repr__(self):
+        return f"MediaItem({self.owner_id}_{self.id}, {self.url or self.player})"
@@ -1,3 +1,25 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+import aiohttp
+from pathlib import Path
+from collections import Counter
+
+logger = logging.getLogger("vkd")
+
+# Список прокси живет сутки, потом yt_dlp_proxy собирает его заново
+PROXY_TTL = 24 * 60 * 60
+# Проверка прокси: запрос к этому адресу через прокси. Для тестов подменяется локальным сервером
+PROBE_URL = "https://vk.com/"
+PROBE_TIMEOUT = 5
+PROBE_CONCURRENCY = 16
+# После стольких ошибок подряд прокси выбывает из пула
+MAX_PROXY_FAILURES = 2
+
+
 def construct_proxy_string(proxy):
     """Construct a proxy string from the proxy dictionary."""
     if proxy.get("username"):
@@ -6,3 +28,115 @@ def construct_proxy_string(proxy):
         )
     return f'{proxy["host"]}:{proxy["port"]}'
 
+
+def proxy_url(proxy: dict) -> str:
+    'Адрес прокси со схемой: в таком виде его понимают и aiohttp, и yt-dlp'
+    return f"http://{construct_proxy_string(proxy)}"
+
+
+def _refresh_proxy_file(path: Path):
+    import yt_dlp_proxy
+    # yt_dlp_proxy пишет proxy.json в текущую папку, переносим его туда, где его ищем мы
+    yt_dlp_proxy.update_proxies()
+    written = Path("proxy.json").resolve()
+    if written != path.resolve() and written.exists():
+        os.replace(written, path)
+
+
+def load_proxies(path: Path, ttl: float = PROXY_TTL) -> list[dict]:
+    'Список прокси из path, обновленный через yt_dlp_proxy, если файла нет или он старше ttl секунд'
+    if not path.exists() or time.time() - path.stat().st_mtime > ttl:
+        logger.info("Обновляем список прокси")
+        try:
+            _refresh_proxy_file(path)
+        except Exception as e:
+            logger.error(f"Не удалось обновить список прокси: {e}")
+    if not path.exists():
+        return []
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+async def probe(session: aiohttp.ClientSession, url: str, probe_url: str = PROBE_URL,
+                timeout: float = PROBE_TIMEOUT) -> float | None:
+    'Задержка ответа probe_url через прокси url в секундах, None если прокси не работает'
+    start = time.perf_counter()
+    try:
+        async with session.get(probe_url, proxy=url, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            if response.status >= 500:
+                return None
+            await response.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError, OSError):
+        return None
+    return time.perf_counter() - start
+
+
+class ProxyPool:
+    '''Пул проверенных прокси, отсортированных по задержке. Каждый воркер получает свой прокси
+    (пока живых прокси хватает на всех), прокси с ошибками подряд выбывают,
+    а их воркеры при следующем acquire() получают следующий живой.
+    Потокобезопасен: acquire()/report_*() вызываются из потоков yt-dlp.'''
+    def __init__(self, proxies: list[dict], probe_url: str = PROBE_URL, timeout: float = PROBE_TIMEOUT,
+                 max_failures: int = MAX_PROXY_FAILURES):
+        self.candidates = {proxy_url(proxy): proxy for proxy in proxies if proxy.get("host")}
+        self.probe_url = probe_url
+        self.timeout = timeout
+        self.max_failures = max_failures
+        self.healthy: list[str] = []
+        self.latency: dict[str, float] = {}
+        self._failures: dict[str, int] = {}
+        self._assigned: dict = {}
+        self._lock = threading.Lock()
+
+    async def probe_all(self, concurrency: int = PROBE_CONCURRENCY) -> list[str]:
+        'Проверяет все прокси одновременно, оставляет живые по возрастанию задержки'
+        semaphore = asyncio.Semaphore(concurrency)
+        async with aiohttp.ClientSession() as session:
+            async def check(url):
+                async with semaphore:
+                    return url, await probe(session, url, self.probe_url, self.timeout)
+            results = await asyncio.gather(*(check(url) for url in self.candidates))
+        with self._lock:
+            self.latency = {url: latency for url, latency in results if latency is not None}
+            self.healthy = sorted(self.latency, key=self.latency.get)
+        logger.info(f"Живых прокси: {len(self.healthy)} из {len(self.candidates)}")
+        for url in self.healthy[:3]:
+            proxy = self.candidates[url]
+            logger.info(f"Прокси {proxy.get('city')}, {proxy.get('country')}: {self.latency[url]:.2f} с")
+        return self.healthy
+
+    def acquire(self, worker) -> str | None:
+        'Прокси воркера: прежний, если он жив и без ошибок, иначе самый быстрый из не занятых другими воркерами'
+        with self._lock:
+            current = self._assigned.get(worker)
+            # после ошибки воркер сразу уходит на другой прокси, а сам прокси пока остается для остальных
+            if current in self.healthy and not self._failures.get(current):
+                return current
+            if not self.healthy:
+                self._assigned.pop(worker, None)
+                return None
+            # самый быстрый среди наименее занятых: пока живых хватает, у каждого воркера свой прокси
+            load = Counter(self._assigned.values())
+            chosen = min(self.healthy, key=lambda url: (url == current, url in self._failures, load[url]))
+            self._assigned[worker] = chosen
+            return chosen
+
+    def report_success(self, url: str):
+        with self._lock:
+            self._failures.pop(url, None)
+
+    def report_failure(self, url: str):
+        'Ошибка или зависание через прокси. После max_failures подряд прокси выбывает из пула'
+        with self._lock:
+            self._failures[url] = self._failures.get(url, 0) + 1
+            if self._failures[url] >= self.max_failures and url in self.healthy:
+                self.healthy.remove(url)
+                logger.warning(f"Прокси {url} выбыл из пула, осталось живых: {len(self.healthy)}")
+
+
+async def build_proxy_pool(path: Path, probe_url: str = PROBE_URL, ttl: float = PROXY_TTL) -> ProxyPool:
+    'Загружает (и при необходимости обновляет) список прокси и проверяет его'
+    proxies = await asyncio.to_thread(load_proxies, path, ttl)
+    pool = ProxyPool(proxies, probe_url)
+    await pool.probe_all()
+    return pool
@@ -0,0 +1,58 @@
+import os
+import shutil
+import logging
+from pathlib import Path
+
+logger = logging.getLogger("vkd")
+
+# Хранилище лежит в корне папки загрузок: жесткие ссылки работают только в пределах одного диска
+STORE_DIR_NAME = ".vkd_store"
+# ioctl FICLONE из linux/fs.h: reflink (copy-on-write копия) на btrfs/xfs
+FICLONE = 0x40049409
+
+
+def _reflink(src: Path, dst: Path):
+    import fcntl
+    with open(src, "rb") as f_src, open(dst, "wb") as f_dst:
+        fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+
+
+class ContentStore:
+    '''Хранилище по содержимому. Каждый уникальный файл лежит один раз под своим sha1,
+    а в папки пользователей, групп, чатов и альбомов ставятся жесткие ссылки на него
+    (или reflink, или, в крайнем случае, копия). Место на диске растет с числом уникальных
+    файлов, а не с числом репостов'''
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def object_path(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest
+
+    def ingest(self, tmp_path: Path, digest: str, target: Path) -> Path:
+        '''Переносит скачанный tmp_path в хранилище (если такого содержимого там еще нет)
+        и ставит на него ссылку target'''
+        obj = self.object_path(digest)
+        if obj.exists():
+            tmp_path.unlink()
+        else:
+            obj.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp_path, obj)
+        self.link(obj, target)
+        return obj
+
+    def link(self, obj: Path, target: Path):
+        target.parent.mkdir(parents=True, exist_ok=True)
+        # ставим ссылку рядом и атомарно переименовываем поверх target
+        tmp = target.with_name(target.name + ".link")
+        tmp.unlink(missing_ok=True)
+        try:
+            os.link(obj, tmp)
+        except OSError:
+            try:
+                _reflink(obj, tmp)
+            except (OSError, ImportError):
+                logger.debug(f"Ни жесткая ссылка, ни reflink недоступны, копируем {target.name}")
+                tmp.unlink(missing_ok=True)
+                shutil.copy2(obj, tmp)
+        os.replace(tmp, target)
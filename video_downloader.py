@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import threading
+import yt_dlp
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+
+from proxy import ProxyPool
+from downloader import make_session, download_ranged, best_mp4_url, RANGE_SEGMENTS
+
+logger = logging.getLogger("vkd")
+
+# Сколько видео качаем одновременно. yt-dlp блокирующий, поэтому каждое видео идет в своем потоке
+VIDEO_WORKERS = 4
+VIDEO_RETRIES = 3
+# Сколько раз одно видео переключается на другой прокси после сетевой ошибки
+PROXY_FAILOVER = 2
+# Признаки того, что виноват прокси или сеть, а не само видео
+NETWORK_ERRORS = ("proxy", "tunnel", "timed out", "timeout", "connection", "unable to download webpage")
+
+YDL_OPTS = {
+    'quiet': True,
+    'noprogress': True,
+    'retries': VIDEO_RETRIES,
+    'fragment_retries': VIDEO_RETRIES,
+    # ошибки поднимаются исключением и уходят в async часть, а не теряются в логе yt-dlp
+    'ignoreerrors': False,
+    # yt-dlp сам пишет во временный .part и докачивает его при следующем запуске
+    'nopart': False,
+    'continuedl': True,
+    'age_limit': 28,
+    # зависший прокси должен закончиться ошибкой, а не висеть бесконечно
+    'socket_timeout': 30,
+}
+
+
+def _is_network_error(error: Exception) -> bool:
+    message = str(error).lower()
+    return any(marker in message for marker in NETWORK_ERRORS)
+
+
+class VideoPool:
+    '''Пул потоков для yt-dlp. У каждого потока свой экземпляр YoutubeDL со своими настройками прокси и повторов,
+    он создается один раз и переиспользуется для всех видео этого потока.
+    С proxy_pool каждый поток берет свой живой прокси, а при сетевой ошибке переключается на другой.
+    download() — корутина: event loop не блокируется, пока видео качаются, а прогресс
+    и ошибки из потоков передаются обратно в loop.
+    Если у видео есть прямые ссылки files, mp4 лучшего качества качается напрямую через aiohttp
+    несколькими запросами Range, а yt-dlp остается запасным путем'''
+    def __init__(self, workers: int = VIDEO_WORKERS, proxy_pool: ProxyPool | None = None, retries: int = VIDEO_RETRIES):
+        self.workers = max(1, workers)
+        self.proxy_pool = proxy_pool
+        self.retries = retries
+        self.failed = 0
+        self.direct = 0
+        self._local = threading.local()
+        self._instances = []
+        self._instances_lock = threading.Lock()
+        self._executor = None
+        self._loop = None
+        self._files = {}
+        self._progress = None
+
+    async def __aenter__(self):
+        self._loop = asyncio.get_running_loop()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="yt-dlp")
+        self._progress = tqdm(total=0, unit="B", unit_scale=True, unit_divisor=1024, desc="Видео")
+        # прямые загрузки: не больше workers видео одновременно, по RANGE_SEGMENTS соединений на каждое
+        self._session = make_session(self.workers * RANGE_SEGMENTS, self.workers * RANGE_SEGMENTS)
+        self._direct_slots = asyncio.Semaphore(self.workers)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        # ждем потоки, не блокируя loop
+        await asyncio.to_thread(self._executor.shutdown, wait=True, cancel_futures=exc_type is not None)
+        for ydl in self._instances:
+            ydl.close()
+        await self._session.close()
+        self._progress.close()
+
+    def _ydl(self, proxy_url: str | None) -> yt_dlp.YoutubeDL:
+        'YoutubeDL текущего потока, пересоздается только при смене прокси'
+        ydl = getattr(self._local, "ydl", None)
+        if ydl is not None and getattr(self._local, "proxy_url", None) == proxy_url:
+            return ydl
+        if ydl is not None:
+            with self._instances_lock:
+                self._instances.remove(ydl)
+            ydl.close()
+        opts = dict(YDL_OPTS, retries=self.retries, fragment_retries=self.retries,
+                    outtmpl="%(id)s.%(ext)s", progress_hooks=[self._hook])
+        if proxy_url:
+            opts['proxy'] = proxy_url # Добавляем прокси если он указан
+        ydl = yt_dlp.YoutubeDL(opts)
+        self._local.ydl, self._local.proxy_url = ydl, proxy_url
+        with self._instances_lock:
+            self._instances.append(ydl)
+        return ydl
+
+    def _hook(self, status: dict):
+        # вызывается из потока yt-dlp: прогресс передаем в loop
+        self._loop.call_soon_threadsafe(self._on_progress, status)
+
+    def _on_progress(self, status: dict):
+        name = status.get("filename")
+        total = status.get("total_bytes") or status.get("total_bytes_estimate") or 0
+        self._files[name] = (status.get("downloaded_bytes") or 0, total)
+        self._progress.total = sum(total for _, total in self._files.values())
+        self._progress.n = sum(done for done, _ in self._files.values())
+        self._progress.refresh()
+
+    def _download_sync(self, video_path: Path, video_link: str):
+        worker = threading.get_ident()
+        for attempt in range(PROXY_FAILOVER + 1):
+            proxy_url = self.proxy_pool.acquire(worker) if self.proxy_pool else None
+            ydl = self._ydl(proxy_url)
+            ydl.params['outtmpl']['default'] = str(video_path)
+            try:
+                ydl.download([video_link])
+            except yt_dlp.utils.DownloadError as e:
+                if proxy_url is None or not _is_network_error(e) or attempt == PROXY_FAILOVER:
+                    raise
+                self.proxy_pool.report_failure(proxy_url)
+                logger.warning(f"Сетевая ошибка через прокси {proxy_url} для {video_path.name}, пробуем другой")
+                continue
+            if proxy_url:
+                self.proxy_pool.report_success(proxy_url)
+            return
+
+    async def _download_direct(self, video_path: Path, url: str) -> bool:
+        async with self._direct_slots:
+            try:
+                result = await download_ranged(self._session, url, video_path)
+            except Exception as e:
+                logger.warning(f"Прямая загрузка {video_path.name} не удалась, пробуем через yt-dlp: {e}")
+                return False
+        if result:
+            self.direct += 1
+            self._on_progress({"filename": str(video_path), "downloaded_bytes": result["size"], "total_bytes": result["size"]})
+            logger.info("Видео загружено: %s" % video_path.name)
+        return result is not None
+
+    async def download(self, video_path: Path, video_link: str, files: dict | None = None) -> bool:
+        'Скачивает видео: напрямую по files, если есть mp4, иначе в потоке пула через yt-dlp. True, если файл на диске'
+        direct_url = best_mp4_url(files)
+        if direct_url and await self._download_direct(video_path, direct_url):
+            return True
+        try:
+            await self._loop.run_in_executor(self._executor, self._download_sync, video_path, video_link)
+            logger.info("Видео загружено: %s" % video_path.name)
+        except yt_dlp.utils.DownloadError as e:
+            self.failed += 1
+            logger.error(f"Ошибка загрузки yt-dlp для {video_link} в {video_path}: {e}")
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Неожиданная ошибка при загрузке видео {video_link} в {video_path}: {e}")
+        return video_path.exists()
@@ -0,0 +1,370 @@
+import json
+import time
+import asyncio
+import logging
+import aiohttp
+from collections import deque
+
+logger = logging.getLogger("vkd")
+
+API_URL = "https://api.vk.com/method/"
+# Та же версия, что по умолчанию использовал vk_api: формат ответов не меняется
+API_VERSION = "5.92"
+# Сколько соединений к api.vk.com держим открытыми одновременно
+API_CONNECTIONS = 20
+# Сколько страниц (окон offset) запрашиваем одновременно при постраничном обходе
+PAGINATION_CONCURRENCY = 10
+# Бюджет запросов к апи в секунду на весь процесс (для пользовательского токена апи разрешает 3)
+API_RATE = 3
+# Коды ошибок "слишком много запросов в секунду" и "flood control"
+THROTTLE_ERROR_CODES = (6, 9)
+# Сколько раз повторяем запрос, упершийся в ограничение
+RATE_LIMIT_RETRIES = 8
+# Пауза после ограничения: база и потолок экспоненциальной задержки, секунды
+RATE_BACKOFF_BASE = 0.5
+RATE_BACKOFF_MAX = 30
+# Максимум вызовов в одном execute (ограничение апи)
+EXECUTE_BATCH_SIZE = 25
+# Сколько ждем остальные вызовы, прежде чем отправить неполную пачку в execute
+EXECUTE_BATCH_DELAY = 0.05
+
+
+class VkApiError(Exception):
+    '''Ошибка, которую вернул апи Вконтакте в поле error'''
+    def __init__(self, method: str, error: dict):
+        self.method = method
+        self.error = error
+        self.code = error.get("error_code")
+        self.error_msg = error.get("error_msg", "")
+        super().__init__(f"[{self.code}] {self.error_msg} (метод {method})")
+
+
+class RateLimiter:
+    '''Token bucket на весь процесс: через него идут все запросы к апи vk.
+    Получив ошибку 6 или 9, уменьшает темп вдвое, выжидает паузу с экспоненциальной задержкой
+    и повторяет запрос сам. После успешных запросов темп постепенно возвращается к rate.'''
+    def __init__(self, rate: float = API_RATE, burst: float | None = None):
+        self._lock = None
+        self._loop = None
+        self.configure(rate, burst)
+
+    def configure(self, rate: float, burst: float | None = None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1.0, self.rate))
+        self.current_rate = self.rate
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._strikes = 0
+
+    def _get_lock(self) -> asyncio.Lock:
+        # лок привязан к event loop, а лимитер живет весь процесс
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._lock = asyncio.Lock()
+            self._loop = loop
+        return self._lock
+
+    async def acquire(self):
+        async with self._get_lock():
+            while True:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.current_rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.current_rate)
+
+    def throttled(self, code: int):
+        self._strikes += 1
+        self.current_rate = max(self.rate / 8, self.current_rate / 2)
+        backoff = min(RATE_BACKOFF_MAX, RATE_BACKOFF_BASE * 2 ** (self._strikes - 1))
+        if code == 9:
+            # flood control держится дольше, чем ограничение в секунду
+            backoff = min(RATE_BACKOFF_MAX, backoff * 4)
+        self._blocked_until = max(self._blocked_until, time.monotonic() + backoff)
+        self._tokens = 0
+        logger.warning(f"Апи ограничил запросы (ошибка {code}), пауза {backoff:.1f} с, темп {self.current_rate:.2f} запр/с")
+
+    def succeeded(self):
+        self._strikes = 0
+        if self.current_rate < self.rate:
+            self.current_rate = min(self.rate, self.current_rate * 1.1)
+
+    async def run(self, request, retries: int = RATE_LIMIT_RETRIES) -> dict:
+        '''Выполняет request() (корутину, возвращающую сырой ответ апи) в рамках бюджета.
+        Ответы с ошибкой 6/9 повторяются, пока не кончатся retries'''
+        for attempt in range(retries + 1):
+            await self.acquire()
+            result = await request()
+            error = result.get("error") if isinstance(result, dict) else None
+            code = error.get("error_code") if isinstance(error, dict) else None
+            if code in THROTTLE_ERROR_CODES:
+                if attempt < retries:
+                    self.throttled(code)
+                    continue
+            else:
+                self.succeeded()
+            return result
+
+
+# Общий лимитер процесса: его используют AsyncVkApi и загрузчик аудио
+rate_limiter = RateLimiter()
+
+
+def _item_key(item):
+    if isinstance(item, dict) and "id" in item:
+        return (item.get("owner_id"), item["id"])
+    return None
+
+
+async def iter_pages(fetch_page, page_size: int = 100, concurrency: int = PAGINATION_CONCURRENCY):
+    '''Постраничный обход методов с offset/count.
+    fetch_page(offset, count) должна вернуть ответ апи с полями count и items.
+    Первая страница дает общее count, остальные окна offset запрашиваются параллельно,
+    не больше concurrency одновременно. Страницы отдаются строго по порядку offset.
+
+    Апи иногда отдает неполную страницу (например, 99 видео вместо 100), хотя дальше
+    есть еще элементы. Offset все равно считаем шагами по page_size, а для неполной страницы
+    дозапрашиваем хвост окна и отбрасываем уже полученные элементы по (owner_id, id).'''
+    first = await fetch_page(0, page_size)
+    total = first.get("count", 0)
+    seen = set()
+
+    def fresh(items):
+        result = []
+        for item in items:
+            key = _item_key(item)
+            if key is not None:
+                if key in seen:
+                    continue
+                seen.add(key)
+            result.append(item)
+        return result
+
+    async def fetch_window(offset):
+        response = await fetch_page(offset, page_size)
+        items = response.get("items", [])
+        # неполная страница не в конце списка: дозапрашиваем остаток окна
+        if 0 < len(items) < page_size and offset + page_size < total:
+            tail = await fetch_page(offset + len(items), page_size - len(items))
+            items = items + tail.get("items", [])
+        return items
+
+    first_items = first.get("items", [])
+    if 0 < len(first_items) < page_size < total:
+        tail = await fetch_page(len(first_items), page_size - len(first_items))
+        first_items = first_items + tail.get("items", [])
+    yield fresh(first_items)
+
+    offsets = iter(range(page_size, total, page_size))
+    pending = deque()
+    try:
+        for offset in offsets:
+            pending.append(asyncio.create_task(fetch_window(offset)))
+            if len(pending) >= max(1, concurrency):
+                break
+        while pending:
+            items = await pending.popleft()
+            next_offset = next(offsets, None)
+            if next_offset is not None:
+                pending.append(asyncio.create_task(fetch_window(next_offset)))
+            yield fresh(items)
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def paginate(fetch_page, page_size: int = 100, concurrency: int = PAGINATION_CONCURRENCY) -> list:
+    'Собирает все страницы iter_pages в один список'
+    all_items = []
+    async for items in iter_pages(fetch_page, page_size, concurrency):
+        all_items.extend(items)
+    return all_items
+
+
+class _ApiMethod:
+    'Позволяет вызывать методы в стиле vk_api: await api.photos.getAll(owner_id=...)'
+    def __init__(self, api, name: str):
+        self._api = api
+        self._name = name
+
+    def __getattr__(self, name):
+        return _ApiMethod(self._api, f"{self._name}.{name}")
+
+    def __call__(self, **params):
+        return self._api.call(self._name, **params)
+
+
+class ExecuteBatcher:
+    '''Собирает вызовы апи, сделанные почти одновременно, в пачки до EXECUTE_BATCH_SIZE
+    и отправляет их одним запросом execute. Каждый вызывающий получает свой результат
+    или свой VkApiError, как если бы метод вызывался напрямую.'''
+    def __init__(self, api, batch_size: int = EXECUTE_BATCH_SIZE, delay: float = EXECUTE_BATCH_DELAY):
+        self.api = api
+        self.batch_size = batch_size
+        self.delay = delay
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+
+    def submit(self, method: str, params: dict) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((method, params, future))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.delay, self._flush)
+        return future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._pending:
+            batch = self._pending[:self.batch_size]
+            del self._pending[:self.batch_size]
+            task = asyncio.create_task(self._send(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    @staticmethod
+    def build_code(batch) -> str:
+        'VKScript для execute: return [API.method1({...}), API.method2({...})];'
+        calls = ",".join(f"API.{method}({json.dumps(params, ensure_ascii=False)})" for method, params, _ in batch)
+        return f"return [{calls}];"
+
+    async def _send(self, batch):
+        if len(batch) == 1:
+            method, params, future = batch[0]
+            await self._send_direct(method, params, future)
+            return
+        try:
+            result = await self.api._request("execute", {"code": self.build_code(batch)})
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        if "error" in result:
+            # execute целиком не прошел (например, слишком большой ответ): отправляем вызовы по одному
+            logger.warning(f"execute не выполнен ({VkApiError('execute', result['error'])}), отправляем {len(batch)} вызовов по одному")
+            await asyncio.gather(*(self._send_direct(method, params, future) for method, params, future in batch))
+            return
+
+        responses = result.get("response") or []
+        # ошибки отдельных вызовов приходят списком execute_errors, в порядке вызовов, вернувших false
+        errors = list(result.get("execute_errors", []))
+        for i, (method, params, future) in enumerate(batch):
+            if future.done():
+                continue
+            response = responses[i] if i < len(responses) else False
+            if response is False:
+                error = next((err for err in errors if err.get("method") == method), None)
+                if error is not None:
+                    errors.remove(error)
+                    future.set_exception(VkApiError(method, error))
+                    continue
+            future.set_result(response)
+
+    async def _send_direct(self, method, params, future):
+        try:
+            result = await self.api._request(method, params)
+            if "error" in result:
+                raise VkApiError(method, result["error"])
+            if not future.done():
+                future.set_result(result["response"])
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+
+
+class AsyncVkApi:
+    '''Асинхронный клиент апи vk на aiohttp. Все запросы идут через один пул соединений,
+    поэтому вызовы можно запускать параллельно через asyncio.gather.
+    С batch=True одновременные вызовы объединяются в execute, см. ExecuteBatcher'''
+    def __init__(self, token: str, version: str = API_VERSION, session: aiohttp.ClientSession | None = None,
+                 page_concurrency: int = PAGINATION_CONCURRENCY, batch: bool = False,
+                 limiter: RateLimiter | None = None):
+        self.token = token
+        self.limiter = limiter or rate_limiter
+        self.version = version
+        self.page_concurrency = page_concurrency
+        self._batcher = ExecuteBatcher(self) if batch else None
+        self._session = session
+        self._own_session = session is None
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return _ApiMethod(self, name)
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # сессию создаем лениво, уже внутри запущенного event loop
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=API_CONNECTIONS),
+                timeout=aiohttp.ClientTimeout(total=60)
+            )
+            self._own_session = True
+        return self._session
+
+    @staticmethod
+    def _prepare_params(params: dict) -> dict:
+        'Приводим параметры к виду, который понимает апи: списки через запятую, bool в 0/1'
+        prepared = {}
+        for key, value in params.items():
+            if value is None:
+                continue
+            if isinstance(value, bool):
+                value = int(value)
+            elif isinstance(value, (list, tuple, set)):
+                value = ",".join(str(v) for v in value)
+            prepared[key] = str(value)
+        return prepared
+
+    async def _request(self, method: str, params: dict) -> dict:
+        '''Один HTTP запрос к апи через общий лимитер, возвращает ответ целиком
+        (response, error, execute_errors)'''
+        data = dict(params)
+        data["access_token"] = self.token
+        data["v"] = self.version
+
+        async def post():
+            async with self._get_session().post(API_URL + method, data=data) as response:
+                response.raise_for_status()
+                return await response.json(content_type=None)
+
+        return await self.limiter.run(post)
+
+    async def call(self, method: str, **params):
+        params = self._prepare_params(params)
+        if self._batcher is not None and method != "execute":
+            return await self._batcher.submit(method, params)
+        result = await self._request(method, params)
+        if "error" in result:
+            raise VkApiError(method, result["error"])
+        return result["response"]
+
+    def _page_fetcher(self, method: str, params: dict):
+        async def fetch_page(offset, count):
+            return await self.call(method, offset=offset, count=count, **params)
+        return fetch_page
+
+    def iter_pages(self, method: str, page_size: int = 100, concurrency: int | None = None, **params):
+        '''Постраничный обход метода апи, см. iter_pages. concurrency=1 — строго по одной странице,
+        когда обход может остановиться рано и забегать вперед незачем'''
+        return iter_pages(self._page_fetcher(method, params), page_size, concurrency or self.page_concurrency)
+
+    async def paginate(self, method: str, page_size: int = 100, **params) -> list:
+        'Все элементы метода апи одним списком, страницы запрашиваются параллельно'
+        return await paginate(self._page_fetcher(method, params), page_size, self.page_concurrency)
+
+    async def close(self):
+        if self._own_session and self._session is not None and not self._session.closed:
+            await self._session.close()
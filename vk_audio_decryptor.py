@@ -3,12 +3,18 @@ import aiohttp
 import logging
 import re
 import os
+import json
+import shutil
 import subprocess
+from collections import deque
 from pathlib import Path
 from urllib.parse import urljoin, urlencode
 from Crypto.Cipher import AES
 from concurrent.futures import ProcessPoolExecutor
 
+from vk_async_api import VkApiError, iter_pages, rate_limiter
+from manifest import Manifest, MANIFEST_NAME
+
 # --- Настройка ---
 logging.basicConfig(
     level=logging.INFO,
@@ -20,6 +26,138 @@ logger = logging.getLogger("vkd_audio")
 DOWNLOADER_CONSUMERS = 5 
 # Количество одновременных конвертеров FFMPEG (рекомендуется os.cpu_count())
 FFMPEG_WORKERS = os.cpu_count() or 1 
+# Сколько страниц audio.get запрашиваем одновременно
+PRODUCER_PAGE_CONCURRENCY = 5
+# Сколько владельцев обходим одновременно, у каждого свой продюсер; лимит запросов к апи общий
+OWNER_CONCURRENCY = 10
+# Длина очередей конвейера на одного потребителя: продюсер и загрузчики не убегают вперед
+QUEUE_PER_WORKER = 4
+# Окно сегментов одного трека: столько качается одновременно и столько максимум лежит в памяти
+SEGMENT_WINDOW = 8
+# Повторы плейлиста, ключа и каждого сегмента с экспоненциальной паузой
+SEGMENT_RETRIES = 4
+RETRY_BACKOFF_BASE = 0.5
+RETRY_BACKOFF_MAX = 8
+# Зависшее соединение заканчивается ошибкой и уходит на повтор, а не держит загрузчик бесконечно
+CONNECT_TIMEOUT = 15
+READ_TIMEOUT = 30
+# MPEG-TS: пакеты по 188 байт, каждый начинается с sync byte 0x47
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+
+
+def retry_delay(attempt: int) -> float:
+    return min(RETRY_BACKOFF_BASE * 2 ** attempt, RETRY_BACKOFF_MAX)
+
+
+def strip_pkcs7(data: bytes) -> bytes:
+    """Снимает PKCS7 паддинг AES-128 из HLS, если он есть: без него остаются целые TS пакеты"""
+    pad = data[-1] if data else 0
+    if 1 <= pad <= 16 and data.endswith(bytes([pad]) * pad) and (len(data) - pad) % TS_PACKET_SIZE == 0:
+        return data[:-pad]
+    return data
+
+
+def is_valid_ts(data: bytes) -> bool:
+    """Целые TS пакеты и sync byte в начале каждого: иначе сегмент битый или расшифрован не тем ключом"""
+    packets = len(data) // TS_PACKET_SIZE
+    return packets > 0 and len(data) % TS_PACKET_SIZE == 0 and data[::TS_PACKET_SIZE] == bytes([TS_SYNC_BYTE]) * packets
+
+
+class TrackIncomplete(Exception):
+    def __init__(self, missing: list[int]):
+        super().__init__(f"не скачаны сегменты {missing[:10]}{'...' if len(missing) > 10 else ''}")
+        self.missing = missing
+
+
+class TrackCheckpoint:
+    """Состояние недокачанного трека рядом с ним: X.ts.part — собранное по порядку начало трека,
+    X.ts.ckpt — с какого сегмента продолжать и сколько байт в .part уже надежно записано,
+    X.ts.segments/ — сегменты, скачанные после пропуска. При следующем запуске качаются только пропущенные"""
+    def __init__(self, ts_path: Path):
+        self.part = ts_path.with_name(ts_path.name + ".part")
+        self.path = ts_path.with_name(ts_path.name + ".ckpt")
+        self.spool = ts_path.with_name(ts_path.name + ".segments")
+        self.next_sequence = None
+        self.size = 0
+
+    def load(self):
+        if not self.path.exists() or not self.part.exists():
+            return
+        state = json.loads(self.path.read_text())
+        if self.part.stat().st_size >= state["size"]:
+            self.next_sequence, self.size = state["next_sequence"], state["size"]
+
+    def spooled(self, sequence: int) -> Path:
+        return self.spool / f"{sequence}.ts"
+
+    def append(self, f_out, sequence: int, data: bytes):
+        'Дописывает сегмент в .part и сдвигает контрольную точку'
+        f_out.write(data)
+        f_out.flush()
+        self.size += len(data)
+        self.next_sequence = sequence + 1
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text(json.dumps({"next_sequence": self.next_sequence, "size": self.size}))
+        os.replace(tmp, self.path)
+        self.spooled(sequence).unlink(missing_ok=True)
+
+    def spool_segment(self, sequence: int, data: bytes):
+        # через временный файл: сегмент, оборванный падением процесса, не выглядит готовым
+        self.spool.mkdir(exist_ok=True)
+        path = self.spooled(sequence)
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+
+    def read_spooled(self, sequence: int) -> bytes | None:
+        'Отложенный сегмент, None если его нет или он битый (тогда он удаляется и качается заново)'
+        path = self.spooled(sequence)
+        if not path.exists():
+            return None
+        data = path.read_bytes()
+        if is_valid_ts(data):
+            return data
+        logger.warning(f"[ЗАГРУЗЧИК] Отложенный сегмент {sequence} поврежден, качаем заново")
+        path.unlink(missing_ok=True)
+        return None
+
+    def clear(self):
+        self.path.unlink(missing_ok=True)
+        shutil.rmtree(self.spool, ignore_errors=True)
+
+
+def copy_file(source: Path, target: Path):
+    """Копия через временный файл: target появляется только целиком"""
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = target.with_name(target.name + ".part")
+    shutil.copy2(source, tmp)
+    os.replace(tmp, target)
+
+
+def parse_playlist(playlist_content: str, base_url: str) -> tuple[list[dict], set[str]]:
+    """Сегменты m3u8 плейлиста по порядку ({"url", "key_uri", "sequence"}) и адреса ключей AES-128"""
+    segments = []
+    key_urls = set()
+    current_key_uri = None
+    media_sequence = 0
+
+    for line in playlist_content.splitlines():
+        line = line.strip()
+        if not line: continue
+        if line.startswith("#EXT-X-MEDIA-SEQUENCE"):
+            media_sequence = int(line.split(':', 1)[1])
+        elif line.startswith("#EXT-X-KEY"):
+            params = {m.group(1): m.group(2).strip('"') for m in re.finditer(r'([A-Z-]+)=(".*?"|[^,]+)', line.split(':', 1)[1])}
+            if params.get("METHOD") == "AES-128":
+                current_key_uri = urljoin(base_url, params.get("URI", ""))
+                if current_key_uri: key_urls.add(current_key_uri)
+            elif params.get("METHOD") == "NONE":
+                current_key_uri = None
+        elif not line.startswith("#"):
+            segments.append({"url": urljoin(base_url, line), "key_uri": current_key_uri, "sequence": media_sequence})
+            media_sequence += 1
+    return segments, key_urls
 
 
 def run_ffmpeg_task(ts_filepath: Path) -> str | None:
@@ -28,6 +166,8 @@ def run_ffmpeg_task(ts_filepath: Path) -> str | None:
     Получает на вход .ts файл, создает файл mp3 и удаляет .ts файл.
     """
     mp3_filepath = ts_filepath.with_suffix(".mp3")
+    # пишем во временный файл: готовый .mp3 на диске всегда целый
+    part_filepath = mp3_filepath.with_name(mp3_filepath.name + ".part")
     
     # Используем -c:a copy для перепаковки без потерь, если это возможно.
     # Для максимальной совместимости можно использовать '-c:a libmp3lame -b:a 192k' для перекодирования.
@@ -35,8 +175,8 @@ def run_ffmpeg_task(ts_filepath: Path) -> str | None:
         'ffmpeg', '-y',
         '-i', str(ts_filepath),
         '-c:a', 'copy', # Простое копирование аудиопотока
-        '-vn', 
-        str(mp3_filepath)
+        '-vn', '-f', 'mp3',
+        str(part_filepath)
     ]
     
     logger.info(f"[FFMPEG] Начало конвертации: {ts_filepath.name} -> {mp3_filepath.name}")
@@ -50,8 +190,9 @@ def run_ffmpeg_task(ts_filepath: Path) -> str | None:
             check=True # Вызовет исключение, если ffmpeg вернет ненулевой код
         )
         if process.returncode == 0:
+            os.replace(part_filepath, mp3_filepath)
             logger.info(f"[FFMPEG] Успешно сконвертирован файл: {mp3_filepath.name}")
-            #ts_filepath.unlink() # Удаляем временный .ts файл
+            ts_filepath.unlink() # Удаляем временный .ts файл
             return str(mp3_filepath)
     except FileNotFoundError:
         logger.error("[FFMPEG] Ошибка: ffmpeg не найден. Убедитесь, что он установлен и доступен в системном PATH.")
@@ -65,11 +206,104 @@ def run_ffmpeg_task(ts_filepath: Path) -> str | None:
 
 
 class Audio:
-    def __init__(self, token, owner_id, download_dir=None):
+    def __init__(self, token, owner_id, download_dir=None, stream=False, manifest: Manifest = None):
         self.token = token
-        self.owner_id = owner_id
-        self.download_dir = Path(download_dir or 'D://ghd/аудио')
+        self.owner_ids = list(owner_id) if isinstance(owner_id, (list, tuple)) else [owner_id]
+        # индекс треков по (owner_id, id) аудио в общем манифесте загрузок: готовое пропускается до любых запросов
+        self.manifest = manifest
+        self._done = {}
+        self._done_owners = set()
+        self._claimed_names = {}
+        # трек, который уже качается для одной библиотеки: key -> mp3 других библиотек, куда его скопировать
+        self._in_flight = {}
+        self.skipped = 0
+        self.copied = 0
+        # потоковый режим: расшифрованные сегменты идут прямо в stdin ffmpeg, без промежуточного .ts на диске
+        self.stream = stream
+        self.download_dir = Path(download_dir or 'D://ghd/аудио').resolve()
         self.download_dir.mkdir(parents=True, exist_ok=True)
+        # отчет по трекам, которые не удалось скачать или сконвертировать: имя -> причина
+        self.failed_tracks = {}
+
+    def _load_done(self, owner_id):
+        if owner_id in self._done_owners:
+            return
+        done = self.manifest.done_paths("audio", [owner_id])
+        self._done.update(done)
+        self._done_owners.add(owner_id)
+        for key, path in done.items():
+            self._claimed_names.setdefault(os.path.relpath(Path(path).with_suffix(".ts"), self.download_dir), key)
+
+    def owner_subdir(self, owner_id) -> str:
+        '''Папка библиотеки владельца относительно download_dir. С одним владельцем треки лежат прямо в download_dir,
+        как и раньше, с несколькими — каждая библиотека в своей подпапке'''
+        return str(owner_id) if len(self.owner_ids) > 1 else ""
+
+    def track_filename(self, item: dict, library_owner) -> str:
+        """Имя .ts для трека из библиотеки library_owner (у трека из каталога свой owner_id, папка — по библиотеке).
+        "Исполнитель - Название" совпадает у разных треков с одинаковыми названиями,
+        поэтому второй и следующие получают в имя id аудио"""
+        key = (item["owner_id"], item["id"])
+        artist = re.sub(r'[\\/*?:"<>|]', '_', item.get('artist', 'Unknown Artist'))
+        title = re.sub(r'[\\/*?:"<>|]', '_', item.get('title', 'Unknown Title'))
+        owner_dir = self.owner_subdir(library_owner)
+        ts_filename = os.path.join(owner_dir, f"{artist} - {title}.ts")
+        if self._claimed_names.setdefault(ts_filename, key) != key:
+            ts_filename = os.path.join(owner_dir, f"{artist} - {title} ({item['id']}).ts")
+            self._claimed_names[ts_filename] = key
+        return ts_filename
+
+    def _recorded(self, key) -> Path | None:
+        'Готовый mp3 трека по индексу, где бы он ни лежал, None если его нет на диске'
+        path = self._done.get(key)
+        return Path(path) if path and Path(path).exists() else None
+
+    def is_done(self, item: dict, library_owner, ts_filename: str | None = None) -> bool:
+        """Трек уже есть в библиотеке library_owner: по индексу, а для библиотек, скачанных до индекса, по готовому .mp3"""
+        key = (item["owner_id"], item["id"])
+        recorded = self._recorded(key)
+        if recorded is not None and recorded.is_relative_to(self.download_dir.joinpath(self.owner_subdir(library_owner))):
+            return True
+        if ts_filename is not None:
+            mp3_path = self.download_dir.joinpath(ts_filename).with_suffix(".mp3")
+            if mp3_path.exists():
+                # в индексе одна запись на трек: копию в другой библиотеке не перезаписываем
+                if recorded is None:
+                    self.mark_done(key, mp3_path)
+                return True
+        return False
+
+    def mark_done(self, key: tuple, mp3_path: Path):
+        owner_id, audio_id = key
+        self._done[key] = str(mp3_path)
+        self.manifest.mark_done(owner_id, "audio", audio_id, None, mp3_path, mp3_path.stat().st_size)
+
+    def claim(self, key: tuple, mp3_path: Path) -> bool:
+        '''True, если трек надо качать. False, если он уже качается для другой библиотеки:
+        тогда mp3 скопируется в mp3_path, когда та загрузка закончится'''
+        waiting = self._in_flight.get(key)
+        if waiting is None:
+            self._in_flight[key] = []
+            return True
+        waiting.append(mp3_path)
+        return False
+
+    async def finish_track(self, key: tuple, mp3_path: Path | None):
+        'Конец загрузки трека: запись в индекс и копии для библиотек, которые ждали этот же трек'
+        waiting = self._in_flight.pop(key, [])
+        if mp3_path is None:
+            for target in waiting:
+                self.report_failure(target.name, "трек не скачан для другой библиотеки")
+            return
+        self.mark_done(key, mp3_path)
+        for target in waiting:
+            if target != mp3_path:
+                await asyncio.to_thread(copy_file, mp3_path, target)
+                self.copied += 1
+
+    def report_failure(self, track_name: str, reason: str):
+        self.failed_tracks[track_name] = reason
+        logger.error(f"[ЗАГРУЗЧИК] Трек не готов: {track_name}: {reason}")
 
     async def download_binary(self, session: aiohttp.ClientSession, url: str) -> bytes | None:
         try:
@@ -79,173 +313,372 @@ class Audio:
         except aiohttp.ClientError as e:
             logger.error(f"Ошибка при скачивании {url}: {e}")
             return None
+        except asyncio.TimeoutError:
+            logger.error(f"Таймаут при скачивании {url}")
+            return None
+
+    async def download_retrying(self, session: aiohttp.ClientSession, url: str, retries: int = SEGMENT_RETRIES) -> bytes | None:
+        for attempt in range(retries + 1):
+            data = await self.download_binary(session, url)
+            if data:
+                return data
+            if attempt < retries:
+                await asyncio.sleep(retry_delay(attempt))
+        return None
 
     def decrypt_segment(self, encrypted_data: bytes, key: bytes, iv: bytes) -> bytes:
         cipher = AES.new(key, AES.MODE_CBC, iv)
-        return cipher.decrypt(encrypted_data)
+        return strip_pkcs7(cipher.decrypt(encrypted_data))
+
+    async def fetch_segment(self, session: aiohttp.ClientSession, seg_info: dict, keys: dict,
+                            checkpoint: TrackCheckpoint | None = None) -> bytes | None:
+        """Расшифрованный и проверенный сегмент, None если он не скачался за все повторы.
+        AES идет в потоках (pycryptodome отпускает GIL), event loop занят только сетью,
+        а расшифровка треков разных загрузчиков идет на разных ядрах"""
+        sequence = seg_info["sequence"]
+        if checkpoint is not None:
+            data = await asyncio.to_thread(checkpoint.read_spooled, sequence)
+            if data is not None:
+                return data
+        key = None
+        if seg_info["key_uri"]:
+            key = keys.get(seg_info["key_uri"])
+            if not key:
+                return None
+        for attempt in range(SEGMENT_RETRIES + 1):
+            enc_data = await self.download_binary(session, seg_info["url"])
+            if enc_data:
+                iv = sequence.to_bytes(16, 'big')
+                try:
+                    data = await asyncio.to_thread(self.decrypt_segment, enc_data, key, iv) if key else enc_data
+                except ValueError as e:
+                    # длина не кратна блоку AES: сегмент обрезан, как и битый TS, качаем заново
+                    logger.warning(f"[ЗАГРУЗЧИК] Сегмент {sequence} не расшифровался ({e}), качаем заново")
+                else:
+                    if is_valid_ts(data):
+                        return data
+                    logger.warning(f"[ЗАГРУЗЧИК] Сегмент {sequence} поврежден (нет sync byte 0x47), качаем заново")
+            if attempt < SEGMENT_RETRIES:
+                await asyncio.sleep(retry_delay(attempt))
+        return None
+
+    async def iter_segments(self, fetch, segments: list[dict], window: int = SEGMENT_WINDOW):
+        """Скользящее окно: впереди качаются (fetch(seg_info)) не больше window сегментов, отдаются они строго по порядку.
+        В памяти одновременно только окно, а не весь трек"""
+        pending = deque()
+        upcoming = iter(segments)
+
+        def fill():
+            while len(pending) < window:
+                seg_info = next(upcoming, None)
+                if seg_info is None:
+                    return
+                pending.append((seg_info, asyncio.create_task(fetch(seg_info))))
+
+        fill()
+        try:
+            while pending:
+                seg_info, task = pending.popleft()
+                data = await task
+                fill()
+                yield seg_info, data
+        finally:
+            for _, task in pending:
+                task.cancel()
+
+    async def stream_segments(self, session: aiohttp.ClientSession, segments: list[dict], keys: dict):
+        """Сегменты трека по порядку для потокового режима. Пропуск в середине не дописывается молча:
+        трек прерывается TrackIncomplete"""
+        fetch = lambda seg_info: self.fetch_segment(session, seg_info, keys)
+        async for seg_info, data in self.iter_segments(fetch, segments):
+            if data is None:
+                raise TrackIncomplete([seg_info["sequence"]])
+            yield data
+
+    async def assemble_file(self, session: aiohttp.ClientSession, segments: list[dict], keys: dict, ts_path: Path) -> list[int]:
+        """Собирает трек в ts_path через .part с контрольной точкой. Возвращает номера сегментов, которые
+        не скачались; тогда ts_path не создается, а следующий запуск докачает только их"""
+        checkpoint = TrackCheckpoint(ts_path)
+        await asyncio.to_thread(checkpoint.load)
+        if checkpoint.next_sequence is not None:
+            logger.info(f"[ЗАГРУЗЧИК] Продолжаем {ts_path.name} с сегмента {checkpoint.next_sequence}")
+            segments = [seg_info for seg_info in segments if seg_info["sequence"] >= checkpoint.next_sequence]
+
+        missing = []
+        fetch = lambda seg_info: self.fetch_segment(session, seg_info, keys, checkpoint)
+        # запись на диск тоже в потоке, чтобы не останавливать остальные загрузки
+        f_out = await asyncio.to_thread(open, checkpoint.part, "r+b" if checkpoint.size else "wb")
+        try:
+            # хвост после последней контрольной точки мог записаться не целиком
+            await asyncio.to_thread(f_out.truncate, checkpoint.size)
+            f_out.seek(checkpoint.size)
+            async for seg_info, data in self.iter_segments(fetch, segments):
+                if data is None:
+                    missing.append(seg_info["sequence"])
+                elif not missing:
+                    await asyncio.to_thread(checkpoint.append, f_out, seg_info["sequence"], data)
+                else:
+                    # после пропуска дописывать нельзя, откладываем сегмент до следующего запуска
+                    await asyncio.to_thread(checkpoint.spool_segment, seg_info["sequence"], data)
+        finally:
+            await asyncio.to_thread(f_out.close)
+
+        if missing:
+            return missing
+        os.replace(checkpoint.part, ts_path)
+        await asyncio.to_thread(checkpoint.clear)
+        return []
+
+    async def pipe_to_ffmpeg(self, chunks, mp3_path: Path) -> bool:
+        """Потоковый режим: ffmpeg читает MPEG-TS из stdin и пишет mp3 во временный файл,
+        который переименовывается в mp3_path только после успешного завершения"""
+        part_path = mp3_path.with_name(mp3_path.name + ".part")
+        try:
+            process = await asyncio.create_subprocess_exec(
+                'ffmpeg', '-y', '-loglevel', 'error',
+                '-f', 'mpegts', '-i', 'pipe:0',
+                '-c:a', 'copy', # Простое копирование аудиопотока
+                '-vn', '-f', 'mp3',
+                str(part_path),
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE
+            )
+        except FileNotFoundError:
+            logger.error("[FFMPEG] Ошибка: ffmpeg не найден. Убедитесь, что он установлен и доступен в системном PATH.")
+            return False
+        # stderr читаем параллельно, иначе ffmpeg встанет на полном буфере
+        stderr_task = asyncio.create_task(process.stderr.read())
+        try:
+            async for chunk in chunks:
+                process.stdin.write(chunk)
+                await process.stdin.drain()
+            process.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            pass # ffmpeg завершился раньше, причина будет в stderr
+        except BaseException:
+            process.kill()
+            await process.wait()
+            part_path.unlink(missing_ok=True)
+            raise
+        returncode = await process.wait()
+        stderr = await stderr_task
+        if returncode != 0:
+            logger.error(f"[FFMPEG] Ошибка при конвертации {mp3_path.name}: {stderr.decode('utf-8', errors='ignore')}")
+            part_path.unlink(missing_ok=True)
+            return False
+        os.replace(part_path, mp3_path)
+        logger.info(f"[FFMPEG] Успешно сконвертирован файл: {mp3_path.name}")
+        return True
 
     async def downloader_logic(self, session: aiohttp.ClientSession, download_queue: asyncio.Queue, conversion_queue: asyncio.Queue) -> None:
-        """Этап 1: Загрузчик. Скачивает и собирает .ts файл, затем передает его в очередь на конвертацию."""
+        """Этап 1: Загрузчик. Скачивает и собирает .ts файл, затем передает его в очередь на конвертацию.
+        Завершается, получив None из download_queue."""
         while True:
+            job = await download_queue.get()
+            if job is None:
+                download_queue.task_done()
+                return
+            m3u8_url, ts_filename, key = job
+            # трек ушел в конвертер (он и закончит трек) или готов здесь; иначе загрузка не удалась
+            handed_off, mp3_done = False, None
             try:
-                m3u8_url, ts_filename = await download_queue.get()
-                
-                logger.info(f"[ЗАГРУЗЧИК] Начал обработку: {ts_filename}")
-                # ... (вся логика парсинга, скачивания и сборки .ts файла) ...
-                base_url = urljoin(m3u8_url, ".")
-                playlist_content_bytes = await self.download_binary(session, m3u8_url)
-                if not playlist_content_bytes:
-                    await asyncio.sleep(0.5)
-                    #download_queue.task_done()
-                    continue
 
+                logger.info(f"[ЗАГРУЗЧИК] Начал обработку: {ts_filename}")
                 output_ts_path = self.download_dir.joinpath(ts_filename).resolve()
-                if output_ts_path.exists():
+                output_ts_path.parent.mkdir(parents=True, exist_ok=True)
+                # готовые треки отсеял продюсер, здесь только собранный, но не сконвертированный .ts
+                if output_ts_path.exists() and not self.stream:
                     logger.info(f"[ЗАГРУЗЧИК] Файл уже существует, пропуск загрузки, передаем в конвертер: {output_ts_path.name}")
                     # Передаем на следующий этап конвейера
-                    await conversion_queue.put(output_ts_path)
+                    await conversion_queue.put((output_ts_path, key))
+                    handed_off = True
                     continue
 
-                playlist_content = playlist_content_bytes.decode('utf-8')
-                segments_to_process = []
-                unique_key_urls = set()
-                current_key_uri = None
-                media_sequence = 0
-
-                for line in playlist_content.splitlines():
-                    line = line.strip()
-                    if not line: continue
-                    if line.startswith("#EXT-X-MEDIA-SEQUENCE"):
-                        media_sequence = int(line.split(':', 1)[1])
-                    elif line.startswith("#EXT-X-KEY"):
-                        params = {m.group(1): m.group(2).strip('"') for m in re.finditer(r'([A-Z-]+)=(".*?"|[^,]+)', line.split(':', 1)[1])}
-                        if params.get("METHOD") == "AES-128":
-                            current_key_uri = urljoin(base_url, params.get("URI", ""))
-                            if current_key_uri: unique_key_urls.add(current_key_uri)
-                        elif params.get("METHOD") == "NONE":
-                            current_key_uri = None
-                    elif not line.startswith("#"):
-                        segments_to_process.append({"url": urljoin(base_url, line), "key_uri": current_key_uri, "sequence": media_sequence})
-                        media_sequence += 1
-                
-                key_tasks = {url: asyncio.create_task(self.download_binary(session, url)) for url in unique_key_urls}
-                segment_tasks = [asyncio.create_task(self.download_binary(session, seg["url"])) for seg in segments_to_process]
-                
+                base_url = urljoin(m3u8_url, ".")
+                playlist_content_bytes = await self.download_retrying(session, m3u8_url)
+                if not playlist_content_bytes:
+                    self.report_failure(ts_filename, "плейлист не скачан")
+                    continue
+
+                segments, key_urls = parse_playlist(playlist_content_bytes.decode('utf-8'), base_url)
+                # ключей на трек один-два и они маленькие, их качаем сразу
+                key_tasks = {url: asyncio.create_task(self.download_retrying(session, url)) for url in key_urls}
                 downloaded_keys = {url: await task for url, task in key_tasks.items()}
-                downloaded_segments_data = await asyncio.gather(*segment_tasks)
-                
-                
-                
-                with open(output_ts_path, "wb") as f_out:
-                    for i, seg_info in enumerate(segments_to_process):
-                        enc_data = downloaded_segments_data[i]
-                        if not enc_data: continue
-                        if seg_info["key_uri"]:
-                            key = downloaded_keys.get(seg_info["key_uri"])
-                            if not key: continue
-                            iv = seg_info["sequence"].to_bytes(16, 'big')
-                            f_out.write(self.decrypt_segment(enc_data, key, iv))
-                        else:
-                            f_out.write(enc_data)
-                
+                if not all(downloaded_keys.values()):
+                    self.report_failure(ts_filename, "не скачан ключ AES-128")
+                    continue
+
+                if self.stream:
+                    # трек пишется на диск один раз, сразу в mp3
+                    try:
+                        converted = await self.pipe_to_ffmpeg(
+                            self.stream_segments(session, segments, downloaded_keys), output_ts_path.with_suffix(".mp3")
+                        )
+                    except TrackIncomplete as e:
+                        self.report_failure(ts_filename, str(e))
+                        continue
+                    if converted:
+                        mp3_done = output_ts_path.with_suffix(".mp3")
+                    else:
+                        self.report_failure(ts_filename, "ошибка ffmpeg")
+                    continue
+
+                missing = await self.assemble_file(session, segments, downloaded_keys, output_ts_path)
+                if missing:
+                    self.report_failure(ts_filename, f"{TrackIncomplete(missing)}, они докачаются при следующем запуске")
+                    continue
+
                 logger.info(f"[ЗАГРУЗЧИК] .ts файл собран: {output_ts_path.name}")
                 # Передаем на следующий этап конвейера
-                await conversion_queue.put(output_ts_path)
+                await conversion_queue.put((output_ts_path, key))
+                handed_off = True
 
-            except asyncio.CancelledError:
-                break
             except Exception as e:
                 logger.error(f"[ЗАГРУЗЧИК] Критическая ошибка: {e}", exc_info=True)
             finally:
+                if not handed_off:
+                    await self.finish_track(key, mp3_done)
                 download_queue.task_done()
-                if download_queue.empty():
-                    asyncio.sleep(10)
 
-    async def vk_audio_producer(self, session: aiohttp.ClientSession, download_queue: asyncio.Queue):
-        """Продюсер: получает список треков и кладет задания в очередь загрузки."""
-        offset = 0
+    async def converter_logic(self, executor: ProcessPoolExecutor, conversion_queue: asyncio.Queue) -> None:
+        """Этап 2: Конвертер. Отдает готовые .ts в пул процессов ffmpeg, пока загрузчики качают следующие.
+        Завершается, получив None из conversion_queue."""
+        loop = asyncio.get_running_loop()
         while True:
-            api_url = self.build_api_url("audio.get", 100, offset)
+            job = await conversion_queue.get()
             try:
-                async with session.get(api_url) as response:
-                    response.raise_for_status()
-                    data = await response.json()
-                    if "response" not in data:
-                        logger.error(f"Ошибка API VK: {data.get('error', {}).get('error_msg', 'Нет поля response')}")
-                        break
-
-                    items = data.get("response", {}).get("items", [])
-                    logger.info(f"Получено {len(items)} аудиозаписей (offset={offset})")
-                    if not items:
-                        logger.info("Все аудиозаписи получены.")
-                        break
-
-                    for item in items:
-                        if item.get("url"):
-                            artist = re.sub(r'[\\/*?:"<>|]', '_', item.get('artist', 'Unknown Artist'))
-                            title = re.sub(r'[\\/*?:"<>|]', '_', item.get('title', 'Unknown Title'))
-                            ts_filename = f"{artist} - {title}.ts"
-                            await download_queue.put((item["url"], ts_filename))
-                        else:
-                            logger.warning(f"Сломанный item: {item}")
-                            logger.warning(f"Пропуск трека без URL: {item.get('artist')} - {item.get('title')}")
-                    
-                    offset += 100
-                    await asyncio.sleep(0.3)
+                if job is None:
+                    return
+                ts_path, key = job
+                # Отправляем задачу в пул процессов, не блокируя основной поток
+                mp3_path = await loop.run_in_executor(executor, run_ffmpeg_task, ts_path)
+                if mp3_path is None:
+                    self.report_failure(ts_path.name, "ошибка ffmpeg")
+                await self.finish_track(key, Path(mp3_path) if mp3_path else None)
             except Exception as e:
-                logger.error(f"Ошибка при получении списка аудио: {e}", exc_info=True)
-                break
+                logger.error(f"[FFMPEG] Ошибка конвертации {job}: {e}")
+            finally:
+                conversion_queue.task_done()
+
+    async def fetch_audio_page(self, session: aiohttp.ClientSession, offset: int, count: int, owner_id=None) -> dict:
+        api_url = self.build_api_url("audio.get", count, offset, owner_id)
+
+        async def request():
+            async with session.get(api_url) as response:
+                response.raise_for_status()
+                return await response.json()
+
+        # общий с остальными запросами к апи лимитер, ошибки 6/9 он повторяет сам
+        data = await rate_limiter.run(request)
+        if "response" not in data:
+            raise VkApiError("audio.get", data.get("error", {"error_msg": "Нет поля response"}))
+        return data["response"]
+
+    async def vk_audio_producer(self, session: aiohttp.ClientSession, download_queue: asyncio.Queue, owner_id=None):
+        """Продюсер: получает список треков владельца и кладет задания в очередь загрузки."""
+        owner_id = self.owner_ids[0] if owner_id is None else owner_id
+
+        async def fetch_page(offset, count):
+            return await self.fetch_audio_page(session, offset, count, owner_id)
+
+        try:
+            async for items in iter_pages(fetch_page, concurrency=PRODUCER_PAGE_CONCURRENCY):
+                logger.info(f"Получено {len(items)} аудиозаписей владельца {owner_id}")
+                for item in items:
+                    key = (item["owner_id"], item["id"])
+                    self._load_done(item["owner_id"])
+                    if self.is_done(item, owner_id):
+                        # уже в индексе: ни плейлиста, ни конвертации
+                        self.skipped += 1
+                        continue
+                    ts_filename = self.track_filename(item, owner_id)
+                    if self.is_done(item, owner_id, ts_filename):
+                        self.skipped += 1
+                        continue
+                    mp3_path = self.download_dir.joinpath(ts_filename).with_suffix(".mp3")
+                    recorded = self._recorded(key)
+                    if recorded is not None:
+                        # трек уже скачан в библиотеку другого владельца: копируем, не качая заново
+                        await asyncio.to_thread(copy_file, recorded, mp3_path)
+                        self.copied += 1
+                        continue
+                    if not item.get("url"):
+                        logger.warning(f"Сломанный item: {item}")
+                        logger.warning(f"Пропуск трека без URL: {item.get('artist')} - {item.get('title')}")
+                        continue
+                    if self.claim(key, mp3_path):
+                        await download_queue.put((item["url"], ts_filename, key))
+            logger.info(f"Все аудиозаписи владельца {owner_id} получены.")
+        except VkApiError as e:
+            logger.error(f"Ошибка API VK для владельца {owner_id}: {e.error_msg}")
+        except Exception as e:
+            logger.error(f"Ошибка при получении списка аудио: {e}", exc_info=True)
 
-    def build_api_url(self, method, count, offset) -> str:
-        params = {"access_token": self.token, "owner_id": self.owner_id[0] if isinstance(self.owner_id, list) else self.owner_id, "count": count, "offset": offset, "v": "5.199"}
+    def build_api_url(self, method, count, offset, owner_id=None) -> str:
+        owner_id = self.owner_ids[0] if owner_id is None else owner_id
+        params = {"access_token": self.token, "owner_id": owner_id, "count": count, "offset": offset, "v": "5.199"}
         return f"https://api.vk.com/method/{method}?{urlencode(params)}"
 
     async def main(self):
-        download_queue = asyncio.Queue()
-        conversion_queue = asyncio.Queue()
-        
+        own_manifest = self.manifest is None
+        if own_manifest:
+            self.manifest = Manifest(self.download_dir.joinpath(MANIFEST_NAME))
+        try:
+            await self._main()
+        finally:
+            if own_manifest:
+                self.manifest.close()
+                self.manifest = None
+
+    async def _main(self):
+        # Очереди ограничены: продюсер ждет загрузчиков, загрузчики ждут конвертеров
+        download_queue = asyncio.Queue(maxsize=DOWNLOADER_CONSUMERS * QUEUE_PER_WORKER)
+        conversion_queue = asyncio.Queue(maxsize=FFMPEG_WORKERS * QUEUE_PER_WORKER)
+
         # Создаем пул процессов для задач, нагружающих CPU
-        loop = asyncio.get_running_loop()
         with ProcessPoolExecutor(max_workers=FFMPEG_WORKERS) as executor:
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None)) as session:
-                # Запускаем потребителей-загрузчиков
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(
+                    total=None, sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)) as session:
+                # Конвертеры работают одновременно с загрузчиками: трек уходит в ffmpeg сразу, как только собран
+                # в потоковом режиме ffmpeg запускают сами загрузчики
+                converter_tasks = [] if self.stream else [
+                    asyncio.create_task(self.converter_logic(executor, conversion_queue))
+                    for _ in range(FFMPEG_WORKERS)
+                ]
                 downloader_tasks = [
                     asyncio.create_task(self.downloader_logic(session, download_queue, conversion_queue))
                     for _ in range(DOWNLOADER_CONSUMERS)
                 ]
-                
-                # Запускаем продюсера
-                producer_task = asyncio.create_task(self.vk_audio_producer(session, download_queue))
-                await producer_task
-                
-                # Ждем, пока все .ts файлы будут скачаны и добавлены в очередь конвертации
-                await download_queue.join()
-
-                # Сигнал конвертерам, что больше файлов не будет
-                for _ in range(FFMPEG_WORKERS):
-                    await conversion_queue.put(None)
-
-                # Запускаем задачи-обертки для CPU-воркеров
-                converter_futures = []
-                while True:
-                    ts_path = await conversion_queue.get()
-                    if ts_path is None:
-                        conversion_queue.task_done()
-                        break
-                    
-                    # Отправляем задачу в пул процессов, не блокируя основной поток
-                    future = loop.run_in_executor(executor, run_ffmpeg_task, ts_path)
-                    converter_futures.append(future)
-                    conversion_queue.task_done()
-
-                # Ожидаем завершения всех задач конвертации
-                if converter_futures:
-                    await asyncio.gather(*converter_futures)
-
-                # Отменяем задачи-загрузчики
-                for task in downloader_tasks:
-                    task.cancel()
-                await asyncio.gather(*downloader_tasks, return_exceptions=True)
+                try:
+                    # по продюсеру на владельца, все кладут в одну очередь загрузки
+                    owner_slots = asyncio.Semaphore(OWNER_CONCURRENCY)
+
+                    async def produce(owner_id):
+                        async with owner_slots:
+                            await self.vk_audio_producer(session, download_queue, owner_id)
+
+                    await asyncio.gather(*(produce(owner_id) for owner_id in self.owner_ids))
+
+                    # Сигнал загрузчикам, что треков больше не будет, и ждем последние загрузки
+                    for _ in downloader_tasks:
+                        await download_queue.put(None)
+                    await asyncio.gather(*downloader_tasks)
+
+                    # Сигнал конвертерам, что файлов больше не будет, и ждем последние конвертации
+                    for _ in converter_tasks:
+                        await conversion_queue.put(None)
+                    await asyncio.gather(*converter_tasks)
+                finally:
+                    for task in downloader_tasks + converter_tasks:
+                        task.cancel()
+                    await asyncio.gather(*downloader_tasks, *converter_tasks, return_exceptions=True)
+
+        logger.info(f"Уже скачано по индексу: {self.skipped}, скопировано из других библиотек: {self.copied}")
+        if self.failed_tracks:
+            logger.warning(f"Не готово треков: {len(self.failed_tracks)}")
+            for track_name, reason in self.failed_tracks.items():
+                logger.warning(f"  {track_name}: {reason}")
 
 if __name__ == "__main__":
     try:
@@ -1,25 +1,29 @@
+import os
 import re
 import sys
+import shutil
 import math
 import time
 import yaml
-import json
-import random
-import vk_api
-import yt_dlp, yt_dlp_proxy
 import logging
 import asyncio
 import aiohttp
 import argparse
-import aiofiles
 from pathlib import Path
+from contextlib import aclosing
 from pytils import numeral
 from tqdm.asyncio import tqdm
-from datetime import datetime
+from urllib.parse import urlsplit
 
 from filter import check_for_duplicates
-from proxy import construct_proxy_string
+from proxy import ProxyPool, build_proxy_pool, PROBE_URL, PROXY_TTL
 from vk_audio_decryptor import Audio
+from manifest import Manifest, MANIFEST_NAME
+from media import MediaItem
+from storage import ContentStore, STORE_DIR_NAME
+from video_downloader import VideoPool, VIDEO_WORKERS
+from downloader import DownloadPool, make_session, download_file, DOWNLOAD_WORKERS, CONNECTIONS_PER_HOST
+from vk_async_api import AsyncVkApi, VkApiError, PAGINATION_CONCURRENCY, API_RATE, EXECUTE_BATCH_SIZE, rate_limiter
 
 logging.basicConfig(
     level=logging.INFO,
@@ -31,6 +35,21 @@ logger = logging.getLogger("vkd")
 APP_DIR = Path(__file__).resolve().parent
 CONFIG_PATH = APP_DIR.joinpath("config.yaml")
 PROXY_PATH = APP_DIR.joinpath("proxy.json")
+# Сколько живет кеш id, имен и названий целей
+ID_CACHE_TTL = 7 * 24 * 60 * 60
+# Сколько id уходит в один users.get / groups.getById / messages.getConversationsById
+USERS_BATCH = 500
+GROUPS_BATCH = 500
+CONVERSATIONS_BATCH = 100
+# Коды ошибок апи, которыми запрос отвергает неверный id: 100 неверный параметр, 113 неверный id пользователя,
+# 125 неверный id группы, 917 нет доступа к чату, 927 чат не существует. Остальные ошибки не про сами id
+INVALID_ID_ERRORS = (100, 113, 125, 917, 927)
+# 7 нет прав на действие, 15 доступ запрещен: у токена без прав на сообщения проверка чата не проходит,
+# и такое число просто не считается чатом
+ACCESS_ERRORS = (7, 15)
+# Сколько живет кеш альбомов. Альбом, которого нет в кеше, все равно перезапрашивается
+ALBUMS_CACHE_TTL = 24 * 60 * 60
+ALBUMS_PAGE = 100
 
 
 def load_config() -> dict:
@@ -62,7 +81,19 @@ class Vkd:
         token = load_token_from_config()
         logger.debug(f"Vkd init — токен загружен: {token}")
 
-        self.session = VkSession(token)
+        config = load_config()
+        self.download_workers = config.get("download_workers", DOWNLOAD_WORKERS)
+        self.connections_per_host = config.get("connections_per_host", CONNECTIONS_PER_HOST)
+        self.video_workers = config.get("video_workers", VIDEO_WORKERS)
+        self.proxy_probe_url = config.get("proxy_probe_url", PROBE_URL)
+        self.proxy_ttl = config.get("proxy_ttl", PROXY_TTL)
+        self.audio_stream = config.get("audio_stream", False)
+        rate_limiter.configure(config.get("api_rate", API_RATE))
+        self.session = VkSession(
+            token,
+            page_concurrency=config.get("api_concurrency", PAGINATION_CONCURRENCY),
+            batch=config.get("api_batch", True)
+        )
         logger.debug("Vkd init — сессия создана")
         self.vk = self.session.vk
 
@@ -75,31 +106,66 @@ class Vkd:
         self.wall = Wall(self.vk, self.groups)
         logger.debug("Vkd init — Wall создан")
 
-        self.photos = Photos(self.vk)
+        self.photos = Photos(self.vk, albums_ttl=config.get("albums_cache_ttl", ALBUMS_CACHE_TTL))
         logger.debug("Vkd init — Photos создан")   
 
         self.messages = Messages(self.vk)
         logger.debug("Vkd init — Messages создан")
 
         self.cli_args = args_from_cli
-        self.utils = Utils(self.vk, self.photos, self.cli_args)
+        self.utils = Utils(self.vk, self.photos, self.cli_args, id_cache_ttl=config.get("id_cache_ttl", ID_CACHE_TTL))
         logger.debug("Vkd init — utils создан")
-        self.vk_ids, self.ids_type = self.utils.vk_resolve_ids(vk_ids)
-        logger.info(f"Vkd init — ids разрешены:{self.vk_ids} с типом {self.ids_type}")
-
-        self.audio = Audio(token=token, owner_id=self.vk_ids, download_dir=BASE_DIR or None)
-        logger.debug("Vkd init — Audio создан")
+        # ids разрешаются в main, запросы к апи асинхронные
+        self.raw_vk_ids = vk_ids
+        self.vk_ids, self.ids_type = [], ''
+        self.token = token
+        # инкрементальный режим: стены и чаты обходим только до уже синхронизированного
+        self.incremental = bool(getattr(args_from_cli, "incremental", False))
+        # хранилище по содержимому: одинаковые файлы лежат на диске один раз, в папках — ссылки
+        self.content_store = bool(getattr(args_from_cli, "content_store", False))
         #self.dir_name: Path = ''
 
+    def _since(self, owner_id, kind: str):
+        'Последний синхронизированный id цели в инкрементальном режиме, иначе None'
+        if not self.incremental:
+            return None
+        watermark = self.manifest.get_watermark(owner_id, kind)
+        return watermark["last_id"] if watermark else None
+
+    def _save_watermarks(self):
+        'Сохраняем после загрузок: если запуск прервется раньше, следующий обход повторится'
+        for owner_id, newest in self.wall.newest_posts.items():
+            self.manifest.set_watermark(owner_id, "wall", newest["last_id"], newest["last_date"])
+        for (chat_id, types), message_id in self.messages.newest_messages.items():
+            self.manifest.set_watermark(chat_id, f"chat_{types}", message_id)
+
     async def main(self, d_photos = None, d_videos = None, d_wall = None, d_chat = None, d_audio = None):
         """
         Основной модуль, принимающий CLI аргументы. Определяет тип аргумента target_id. Скачивает фото/видео в зависимости от параметров
         d_photos, d_videos, d_wall, d_chat
         """
+        self.manifest = Manifest(BASE_DIR.joinpath(MANIFEST_NAME))
+        self.utils.manifest = self.manifest
+        self.photos.manifest = self.manifest
+        self.store = ContentStore(BASE_DIR.joinpath(STORE_DIR_NAME)) if self.content_store else None
+        try:
+            await self._main(d_photos, d_videos, d_wall, d_chat, d_audio)
+        finally:
+            self.manifest.close()
+            await self.session.close()
+
+    async def _main(self, d_photos, d_videos, d_wall, d_chat, d_audio):
+        self.vk_ids, self.ids_type = await self.utils.vk_resolve_ids(self.raw_vk_ids)
+        logger.info(f"Vkd init — ids разрешены:{self.vk_ids} с типом {self.ids_type}")
+
+        # id групп в vk_ids уже отрицательные, как их ждет audio.get
+        self.audio = Audio(token=self.token, owner_id=self.vk_ids, download_dir=BASE_DIR or None, stream=self.audio_stream,
+                           manifest=self.manifest)
+        logger.debug("Vkd init — Audio создан")
+
         type = self.ids_type
-        all_photos = []
-        all_videos = []
-        d_dir = None # на случай, если провалили всё внутри main и хотим запустить check_for_duplicates. Она вернет 0
+        all_videos = [] # (папка, видео): видео качаются после обхода
+        target_dirs = [] # папки всех целей, в каждой потом ищем дубликаты
         
         # проверки несовместимых комбинаций параметров
         if type =='user' and d_chat:
@@ -119,161 +185,182 @@ class Vkd:
         if d_audio:
             await self.audio.main()
             
-
-        if type == 'group': 
-            if self.utils.check_group_ids(self.vk_ids):
-                for group in self.vk_ids:
-                    all_photos.clear()
-                    all_videos.clear()
-
-                    if d_wall:
-                        # получаем посты со стены (сохраняются в groups.photos)
-                        logger.info(f"Пытаемся получить фото стены")
-                        all_photos.extend(self.wall.vk_get_posts(group_id=group))
-                        logger.info(f"Пытаемся получить фото стены: получили {len(all_photos)}")
+        # конвейер: каждая полученная страница сразу уходит в ограниченную очередь загрузки фото
+        async with PhotoDownloader(self.utils, self.download_workers, self.connections_per_host, self.manifest,
+                                   self.store) as photo_downloader:
+            if type == 'group': 
+                if await self.utils.check_group_ids(self.vk_ids):
                     if d_photos:
-                        logger.info(f"Пытаемся получить все альбомы группы: {group}")
-                        items = self.photos.vk_getALL(group)
-                        logger.info(f"Пытаемся получить все альбомы группы: собрали фотографий {len(items)}")
-                        all_photos.extend(self.utils.extract_from_raw_data(type='photos', raw_data=items, owner_id=group))
-                    if d_videos:
-                        # ВИДЕО ШОРТЫ НЕ РАБОТАЮТ В КОНТАКТЕ, ИХ АПИ НЕ ГОТОВО, ОБХОДНОЙ ПУТЬ БАГНУТЫЙ
-                        # logger.info(f"Пытаемся получить все видео группы: {group}")
-                        # logger.info(f"Пытаемся получить видео шорты со стены")
-                        # items = self.wall.vk_get_posts(group_id=group, only_videos=True)
-                        # all_videos.extend(self.utils.extract_from_raw_data(type='videos', raw_data=items, owner_id=group))
-                        # logger.info(f"Пытаемся получить видео шорты со стены: собрали {len(items)}")
-
-                        items = self.video.vk_video_get(group)
-                        logger.info(f"Пытаемся получить все видео группы: собрали {len(items)}")
-                        all_videos.extend(self.utils.extract_from_raw_data(type='videos', raw_data=items, owner_id=group))
-
-                    group_name = self.utils.get_group_title(group)
-                    d_dir = BASE_DIR.joinpath(group_name)
-                    self.utils.create_dir(d_dir)
-
-        if type == 'user':
-            if self.utils.check_user_ids(self.vk_ids):
-                for user in self.vk_ids:
-                    all_photos.clear()
-                    all_videos.clear()
-
+                        # альбомы всех целей одной пачкой запросов, дальше они берутся из кеша
+                        await self.photos.load_albums(self.vk_ids)
+                    for group in self.vk_ids:
+                        group_name = await self.utils.get_group_title(group)
+                        d_dir = BASE_DIR.joinpath(group_name)
+                        self.utils.create_dir(d_dir)
+                        target_dirs.append(d_dir)
+                        photo_downloader.add_target(d_dir)
+
+                        if d_wall:
+                            # получаем посты со стены
+                            logger.info(f"Пытаемся получить фото стены")
+                            count = await self._stream_wall(photo_downloader, d_dir, group)
+                            logger.info(f"Пытаемся получить фото стены: получили {count}")
+                        if d_photos:
+                            logger.info(f"Пытаемся получить все альбомы группы: {group}")
+                            count = await self._stream_photos(photo_downloader, d_dir, group, self.photos.iter_getALL(group))
+                            logger.info(f"Пытаемся получить все альбомы группы: собрали фотографий {count}")
+                        if d_videos:
+                            # ВИДЕО ШОРТЫ НЕ РАБОТАЮТ В КОНТАКТЕ, ИХ АПИ НЕ ГОТОВО, ОБХОДНОЙ ПУТЬ БАГНУТЫЙ
+                            # logger.info(f"Пытаемся получить все видео группы: {group}")
+                            # logger.info(f"Пытаемся получить видео шорты со стены")
+                            # items = [item async for page in self.wall.iter_posts(group, only_videos=True) for item in page]
+                            # all_videos.extend(self.utils.iter_extract('videos', items))
+                            # logger.info(f"Пытаемся получить видео шорты со стены: собрали {len(items)}")
+
+                            videos = await self._collect_videos(group)
+                            logger.info(f"Пытаемся получить все видео группы: собрали {len(videos)}")
+                            all_videos.append((d_dir, videos))
+
+            if type == 'user':
+                if await self.utils.check_user_ids(self.vk_ids):
                     if d_photos:
-                        items = self.photos.vk_user_get(user, 'saved')
-                        logger.info(f"Пытаемся получить фото: saved получили {len(items)}")
-                        all_photos.extend(self.utils.extract_from_raw_data(type='photos', raw_data=items, owner_id=user))
-
-                        items = self.photos.vk_user_get(user, 'profile')
-                        logger.info(f"Пытаемся получить фото: profile получили {len(items)}")
-                        all_photos.extend(self.utils.extract_from_raw_data(type='photos', raw_data=items, owner_id=user))
-
-                        items = self.photos.vk_user_get(user, 'wall')
-                        logger.info(f"Пытаемся получить фото: wall получили {len(items)}")
-                        all_photos.extend(self.utils.extract_from_raw_data(type='photos', raw_data=items, owner_id=user))
-
-                        items = self.photos.vk_getALL(user, 'user')
-                        logger.info(f"Пытаемся получить фото: getall получили {len(items)}")
-                        all_photos.extend(self.utils.extract_from_raw_data(type='photos', raw_data=items, owner_id=user))
-
-                    if d_videos:
-                        logger.info(f"Пытаемся получить все видео пользователя: {user}")
-                        items = self.video.vk_video_get(user)
-                        logger.info(f"Пытаемся получить все видео пользователя: собрали {len(items)}")
-                        all_videos.extend(self.utils.extract_from_raw_data(type='videos', raw_data=items, owner_id=user))
-
-                    if d_wall:
-                        logger.info(f"Пытаемся получить фото стены")
-                        all_photos.extend(self.wall.vk_get_posts(user))
-                        logger.info(f"Пытаемся получить фото стены: получили {len(self.groups.photos)}")
-
-                    username = self.utils.get_username(user)
-                    d_dir = BASE_DIR.joinpath(username)
+                        # альбомы всех целей одной пачкой запросов, дальше они берутся из кеша
+                        await self.photos.load_albums(self.vk_ids)
+                    for user in self.vk_ids:
+                        username = await self.utils.get_username(user)
+                        d_dir = BASE_DIR.joinpath(username)
+                        self.utils.create_dir(d_dir)
+                        target_dirs.append(d_dir)
+                        photo_downloader.add_target(d_dir)
+
+                        if d_photos:
+                            # все источники фото обходим одновременно, страницы сразу идут в загрузку
+                            counts = await asyncio.gather(
+                                self._stream_photos(photo_downloader, d_dir, user, self.photos.iter_user_get(user, 'saved')),
+                                self._stream_photos(photo_downloader, d_dir, user, self.photos.iter_user_get(user, 'profile')),
+                                self._stream_photos(photo_downloader, d_dir, user, self.photos.iter_user_get(user, 'wall')),
+                                self._stream_photos(photo_downloader, d_dir, user, self.photos.iter_getALL(user))
+                            )
+                            for name, count in zip(('saved', 'profile', 'wall', 'getall'), counts):
+                                logger.info(f"Пытаемся получить фото: {name} получили {count}")
+
+                        if d_videos:
+                            logger.info(f"Пытаемся получить все видео пользователя: {user}")
+                            videos = await self._collect_videos(user)
+                            logger.info(f"Пытаемся получить все видео пользователя: собрали {len(videos)}")
+                            all_videos.append((d_dir, videos))
+
+                        if d_wall:
+                            logger.info(f"Пытаемся получить фото стены")
+                            count = await self._stream_wall(photo_downloader, d_dir, user)
+                            logger.info(f"Пытаемся получить фото стены: получили {count}")
+
+            if type == 'chat':
+                for chat in self.vk_ids:
+                    chat_title_or_name = "Неизвестный чат" # Значение по умолчанию
+                    if await self.utils.check_chat_id(chat):
+                        if chat > 0:
+                            chat_title_or_name = await self.utils.get_username(str(chat))
+                        elif chat < 0:
+                            chat_title_or_name = await self.utils.get_chat_title(str(chat))
+                    else:
+                        logger.error(f"Не смогли определить чат {chat}")
+                        continue # или обработать ошибку иначе
+
+                    d_dir = BASE_DIR.joinpath(f"Переписка {safe_filename(chat_title_or_name)}")
                     self.utils.create_dir(d_dir)
-
-        if type == 'chat':
-            for chat in self.vk_ids:
-                all_photos.clear()
-                all_videos.clear()
-
-                chat_title_or_name = "Неизвестный чат" # Значение по умолчанию
-                if self.utils.check_chat_id(chat):
-                    if chat > 0:
-                        chat_title_or_name = self.utils.get_username(str(chat))
-                    elif chat < 0:
-                        chat_title_or_name = self.utils.get_chat_title(str(chat))
-                else:
-                    logger.error(f"Не смогли определить чат {chat}")
-                    continue # или обработать ошибку иначе
-
-                
-                if d_photos and d_videos:
-                    items = self.messages.vk_getHistoryAttachments(chat, "photo")
-                    items.extend(self.messages.vk_getHistoryAttachments(chat, "video")) # видео не работают, будет пустой результат
-                elif d_photos:
-                    items = self.messages.vk_getHistoryAttachments(chat, "photo")
-                elif d_videos:
-                    items = self.messages.vk_getHistoryAttachments(chat, "video") # видео не работают, будет пустой результат
-                logger.info(f"Пытаемся получить фото из переписки: получили {len(items)}")
-                all_photos.extend(self.utils.extract_from_raw_data(type='chat', raw_data=items, owner_id=chat))
-                logger.info(f'Обработаны items {len(items)}, в photos лежит {len(all_photos)}')
-
-                d_dir = BASE_DIR.joinpath(f"Переписка {safe_filename(chat_title_or_name)}")
-                self.utils.create_dir(d_dir)
-                
-        if d_photos or d_wall:
-            await download_photos(self.utils, d_dir, all_photos)
-        if d_videos:
-            await download_videos(d_dir, all_videos, self.cli_args)
-        if 'd_dir' in locals() and d_dir.exists(): # Проверяем, была ли d_dir создана и существует
-            logger.info("Проверка на дубликаты")
-            dublicates_count = check_for_duplicates(d_dir)
+                    target_dirs.append(d_dir)
+                    photo_downloader.add_target(d_dir)
+
+                    media_types = [media for media, wanted in (("photo", d_photos), ("video", d_videos)) if wanted] # видео не работают, будет пустой результат
+                    counts = await asyncio.gather(*(
+                        self._stream_photos(
+                            photo_downloader, d_dir, chat,
+                            self.messages.iter_history_attachments(chat, media, self._since(chat, f"chat_{media}")),
+                            type='chat'
+                        )
+                        for media in media_types
+                    ))
+                    logger.info(f"Пытаемся получить фото из переписки: получили {sum(counts)}")
+
+        if d_videos and all_videos:
+            # один пул потоков yt-dlp на все цели
+            proxy_pool = await make_proxy_pool(self.cli_args, self.proxy_probe_url, self.proxy_ttl)
+            async with VideoPool(self.video_workers, proxy_pool) as video_pool:
+                for d_dir, videos in all_videos:
+                    await download_videos(d_dir, videos, self.cli_args, self.manifest, video_pool)
+        self._save_watermarks()
+
+        dublicates_count = 0
+        if self.store is None:
+            for d_dir in target_dirs:
+                if d_dir.exists():
+                    logger.info(f"Проверка на дубликаты: {d_dir}")
+                    dublicates_count += check_for_duplicates(d_dir)
             logger.info(f"Дубликатов удалено: {dublicates_count}")
         else:
-            dublicates_count = 0 # Если директория не была создана/указана
-
-        logger.info(f"Итого скачено: {len(all_photos + all_videos) - dublicates_count} медиафайлов")
+            # повторы уже сведены к одному файлу в хранилище по хешу, посчитанному при загрузке
+            logger.info("Проверка на дубликаты не нужна: одинаковые фото связаны ссылками на один файл хранилища")
+
+        total = photo_downloader.queued + photo_downloader.skipped + sum(len(videos) for _, videos in all_videos)
+        logger.info(f"Итого скачено: {total - dublicates_count} медиафайлов")
+
+    async def _stream_photos(self, photo_downloader, d_dir: Path, owner_id, pages, type='photos') -> int:
+        '''Каждая страница из обхода апи сразу проходит iter_extract и уходит в очередь загрузки:
+        в памяти живет одна сырая страница, а не весь список фото цели'''
+        albums_dict = await self.photos.vk_getAlbums(owner_id) if type == 'photos' else None
+        count = 0
+        async with aclosing(pages):
+            async for items in pages:
+                if albums_dict is not None and any(photo.get("album_id") not in albums_dict for photo in items):
+                    # альбом создан после того, как список попал в кеш
+                    albums_dict = await self.photos.vk_getAlbums(owner_id, refresh=True)
+                count += await photo_downloader.add(d_dir, self.utils.iter_extract(type, items, albums_dict))
+        return count
+
+    async def _collect_videos(self, owner_id) -> list[MediaItem]:
+        'Видео владельца компактными MediaItem: сырые страницы video.get отпускаются сразу после разбора'
+        videos = []
+        pages = self.video.iter_video_get(owner_id)
+        async with aclosing(pages):
+            async for items in pages:
+                videos.extend(self.utils.iter_extract('videos', items))
+        return videos
+
+    async def _stream_wall(self, photo_downloader, d_dir: Path, owner_id) -> int:
+        count = 0
+        pages = self.wall.iter_posts(owner_id, since_id=self._since(owner_id, "wall"))
+        async with aclosing(pages):
+            async for wall_items in pages:
+                count += len(wall_items)
+                await photo_downloader.add(d_dir, wall_items)
+        return count
 
 class VkSession:
     '''Класс для авторизации по токену, создает в параметр vk, использующий апи Вконтакте'''
-    def __init__(self, token):
-        vk_session = vk_api.VkApi(token=token)
-        self.vk = vk_session.get_api()
+    def __init__(self, token, page_concurrency=PAGINATION_CONCURRENCY, batch=True):
+        self.vk = AsyncVkApi(token, page_concurrency=page_concurrency, batch=batch)
         logger.info("Успешно авторизовались")
 
+    async def close(self):
+        await self.vk.close()
+
 class Video:
     '''Основной класс для получения видео через апи.'''
     def __init__(self, vk):
         self.vk = vk
 
-    def vk_video_get(self, owner_id) -> dict:
-        offset = 0
-        all_videos = []
-        while True:
-            response = self.vk.video.get(
-                owner_id=owner_id,
-                count=100,
-                offset=offset
-            )
-            count = response["count"]
-            temp = response["items"]
-            logger.info(f"Сбор видео: длина items {len(temp)}")
-            logger.info(f"Сбор видео: Ожидаем{count} получено {len(all_videos)}")
-            all_videos.extend(temp)
-
-            if len(temp) < 100:
-                if len(temp)==99 and offset==0:
-                    offset+=99
-                    continue
-                break
-            offset += 100
-        return all_videos
-    
-    def vk_getVideoByid(self, owner_id, video_id) -> dict:
+    def iter_video_get(self, owner_id):
+        'Постранично все видео владельца'
+        return self.vk.iter_pages("video.get", owner_id=owner_id)
+
+    async def vk_getVideoByid(self, owner_id, video_id) -> dict:
         logger.info(f"Получаем видео по id {video_id}")
-        return self.vk.video.get(
+        response = await self.vk.video.get(
             owner_id=owner_id,
             videos = video_id
-        )["items"]
+        )
+        return response["items"]
 
 class Groups:
     'Вспомогательный класс Groups используется в связке Wall для получения фото постов стены'
@@ -285,30 +372,22 @@ class Groups:
         """Проходимся по всем вложениям поста и отбираем только картинки"""
         post_items = []
         try:
-            for i, attachment in enumerate(post["attachments"]):
+            for attachment in post["attachments"]:
                 if attachment["type"] == "photo":
-                    file_type = attachment["type"]
-                    photo_id = post["attachments"][i]["photo"]["id"]
-                    owner_id = post["attachments"][i]["photo"]["owner_id"]
-                    photo_url = post["attachments"][i]["photo"]["sizes"][-1].get("url")
-                    if photo_url != None or photo_url != '':
-                        post_items.append({
-                            "type": file_type,
-                            "id": photo_id,
-                            "owner_id": owner_id,
-                            "url": photo_url,
-                            "date": datetime.fromtimestamp(int(post["attachments"][i]["photo"]["date"])).strftime('%Y-%m-%d %H-%M-%S')
-                        })
+                    item = MediaItem.from_photo(attachment["photo"], type=attachment["type"])
+                    if item.url != None or item.url != '':
+                        post_items.append(item)
         except Exception as e:
             raise(e)
         
         return post_items
     
-    def get_single_post_video(self, post:dict):
+    async def get_single_post_video(self, post:dict):
         """Проходимся по всем вложениям поста и отбираем только видео-шорты"""
         post_items = []
         attachments = post.get("attachments")
         try:
+            requests = []
             for attachment in attachments:
                 if attachment.get("type") == "video":
                     #if attachment.get("video").get("type") == "short_video":
@@ -317,10 +396,11 @@ class Groups:
                         owner_id = attachment.get("video").get("owner_id")
                         video_id = f'{owner_id}_{id}'
                         #print(video_id)
-                        video_item = self.videos.vk_getVideoByid(owner_id, video_id)
-                        post_items.extend(video_item)
+                        requests.append(self.videos.vk_getVideoByid(owner_id, video_id))
                     #else:
                         #logger.info("Вложение с обычным видео, не short")
+            for video_item in await asyncio.gather(*requests):
+                post_items.extend(video_item)
         except Exception as e:
             logger.error(e)
         
@@ -332,469 +412,622 @@ class Wall:
         self.vk = vk
         self.groups = groups
         self.group_id = group_id
-
-
-    def vk_get_posts(self, group_id, only_videos=None):
-        'Получаем со стены по 100 постов за проход и проверяем вложения, возвращаем обработанный список wall_items с фото, готовый к загрузке'
-        wall_items = []
-        offset = 0
-        while True:
-            posts = self.vk.wall.get(
-                owner_id=group_id,
-                count=100,
-                offset=offset
-            )["items"]
-            for post in posts:
-                try:
-                    # Пропускаем посты с рекламой
-                    if post["marked_as_ads"]:
-                        logger.info("Игнорируем пост с рекламой")
-                        continue
-
-                    attachments = post.get("attachments", [])
-                    if not attachments:
-                        logger.info("Пропущен пост без вложений")
-                        continue  # или continue, в зависимости от контекста
-
-                    # Если пост скопирован с другой группы
-                    if "copy_history" in post:
-                        logger.info("Пост с другой группы, проверяем вложения")
-                        if not only_videos:
-                            if "attachments" in post["copy_history"][0]:
-                                wall_items.extend(self.groups.get_single_post(post["copy_history"][0]))
-
-                    if attachments:
-                        if only_videos:
-                            try:
-                                for attachment in attachments:
-                                    if attachment.get("type") == "video":
-                                        logger.debug(f"пробуем достать видео из поста.")
-                                        wall_items.extend(self.groups.get_single_post_video(post)) #возвращает видео-айди из постов
-                            except Exception as e:
-                                logger.error("Ошибка парсинга поста", post, e)
-                        else:
-                            wall_items.extend(self.groups.get_single_post(post))
-                except Exception as e:
-                    logger.error("Иная ошибка парсинга поста", post, e)
-
-            logger.info(f"Собрали со стены медиафайлов: {len(wall_items)}")
-            if len(posts) < 100:
-                break
-            offset += 100
-
+        # самый новый пост, увиденный при последнем обходе каждой стены: {"last_id", "last_date"}
+        self.newest_posts = {}
+
+
+    async def iter_posts(self, group_id, only_videos=None, since_id=None):
+        '''Получаем со стены по 100 постов за проход и проверяем вложения, отдаем обработанные wall_items с фото постранично, готовые к загрузке.
+        С since_id обход инкрементальный: останавливаемся на первом незакрепленном посте с id не больше since_id.
+        Закрепленный пост стоит первым независимо от даты, поэтому старый закрепленный просто пропускаем'''
+        total = 0
+        newest = None
+        reached_seen = False
+        # в инкрементальном режиме обход обычно кончается на первых страницах, забегать вперед незачем
+        pages = self.vk.iter_pages("wall.get", concurrency=1 if since_id is not None else None, owner_id=group_id)
+        try:
+            async with aclosing(pages):
+                async for posts in pages:
+                    wall_items = []
+                    for post in posts:
+                        if newest is None or post["id"] > newest["last_id"]:
+                            newest = {"last_id": post["id"], "last_date": post.get("date")}
+                        if since_id is not None and post["id"] <= since_id:
+                            if post.get("is_pinned"):
+                                continue
+                            reached_seen = True
+                            break
+                        try:
+                            # Пропускаем посты с рекламой
+                            if post["marked_as_ads"]:
+                                logger.info("Игнорируем пост с рекламой")
+                                continue
+
+                            attachments = post.get("attachments", [])
+                            if not attachments:
+                                logger.info("Пропущен пост без вложений")
+                                continue  # или continue, в зависимости от контекста
+
+                            # Если пост скопирован с другой группы
+                            if "copy_history" in post:
+                                logger.info("Пост с другой группы, проверяем вложения")
+                                if not only_videos:
+                                    if "attachments" in post["copy_history"][0]:
+                                        wall_items.extend(self.groups.get_single_post(post["copy_history"][0]))
+
+                            if attachments:
+                                if only_videos:
+                                    try:
+                                        for attachment in attachments:
+                                            if attachment.get("type") == "video":
+                                                logger.debug(f"пробуем достать видео из поста.")
+                                                wall_items.extend(await self.groups.get_single_post_video(post)) #возвращает видео-айди из постов
+                                    except Exception as e:
+                                        logger.error("Ошибка парсинга поста", post, e)
+                                else:
+                                    wall_items.extend(self.groups.get_single_post(post))
+                        except Exception as e:
+                            logger.error("Иная ошибка парсинга поста", post, e)
+
+                    total += len(wall_items)
+                    logger.info(f"Собрали со стены медиафайлов: {total}")
+                    yield wall_items
+                    if reached_seen:
+                        logger.info("Дошли до уже синхронизированных постов")
+                        break
+        finally:
+            if newest is not None:
+                self.newest_posts[group_id] = newest
         logger.info("Закончили парсить посты стены")
-        return wall_items
 
 class Photos:
     '''Основной класс для получения фотографий через апи vk.'''
-    def __init__(self, vk):
+    def __init__(self, vk, manifest: Manifest = None, albums_ttl: float = ALBUMS_CACHE_TTL):
         self.vk = vk
+        self.manifest = manifest
+        self.albums_ttl = albums_ttl
+        # альбомы владельцев за этот запуск: owner_id -> {album_id: название}
+        self._albums = {}
+        self._albums_refreshed = set()
+        self._albums_pending = {}
+
+    def iter_getALL(self, owner_id):
+        'Постранично все фото владельца'
+        return self.vk.iter_pages("photos.getAll", owner_id=owner_id, extended=True)
+
+    def iter_user_get(self, user_id, album:str):
+        'Постранично фото с альбома'
+        return self.vk.iter_pages(
+            "photos.get",
+            user_id=user_id,
+            album_id=album,
+            photo_sizes=True,
+            extended=True
+        )
 
-    def vk_getALL(self, owner_id) -> dict:
-        offset = 0
-        all_photos = []
-        while True:
-            temp = self.vk.photos.getAll(
-                owner_id=owner_id,
-                extended=True,
-                count=100,
-                offset=offset
-            )["items"]
-
-            all_photos.extend(temp)
-
-            if len(temp) < 100:
-                break
-            offset += 100
-        return all_photos
-    
-    def vk_user_get(self, user_id, album:str) -> dict:
-        offset = 0
-        all_photos = []
-        while True:
-            # Собираем фото с альбома
-            temp = self.vk.photos.get(
-                user_id=user_id,
-                count=100,
-                offset=offset,
-                album_id=album,
-                photo_sizes=True,
-                extended=True
-            )["items"]
-
-            all_photos.extend(temp)
-
-            if len(temp) < 100:
-                break
-            offset += 100
-        return all_photos
-
-    def vk_getAlbums(self, owner_id) -> dict[int, str]:
+    async def _fetch_albums(self, owner_id) -> dict[int, str] | None:
+        'Все альбомы владельца постранично, None при ошибке апи'
+        albums = {}
+        pages = self.vk.iter_pages("photos.getAlbums", page_size=ALBUMS_PAGE, owner_id=owner_id, need_system=True)
         try:
-            response = self.vk.photos.getAlbums(owner_id=owner_id, need_system=True)
-            albums = response.get("items", [])
-            return {album["id"]: album["title"] for album in albums}
+            async with aclosing(pages):
+                async for items in pages:
+                    albums.update((album["id"], album["title"]) for album in items)
         except Exception as e:
-            logger.error(f"Ошибка при получении альбомов: {e}")
-            return {}
-  
+            logger.error(f"Ошибка при получении альбомов {owner_id}: {e}")
+            return None
+        return albums
+
+    async def load_albums(self, owner_ids, refresh: bool = False) -> dict:
+        '''Альбомы сразу нескольких владельцев: owner_id -> {album_id: название}.
+        Берутся из памяти этого запуска, потом из кеша в манифесте, остальные запрашиваются одновременно
+        (одновременные запросы апи уходят пачками через execute). refresh — перезапросить из апи,
+        но не больше одного раза за запуск на владельца'''
+        owner_ids = list(dict.fromkeys(owner_ids))
+        if refresh:
+            missing = [owner_id for owner_id in owner_ids if owner_id not in self._albums_refreshed]
+        else:
+            missing = [owner_id for owner_id in owner_ids if owner_id not in self._albums]
+            if missing and self.manifest is not None:
+                cached = self.manifest.cache_get("albums", missing, self.albums_ttl)
+                for owner_id in missing:
+                    if str(owner_id) in cached:
+                        # ключи json всегда строки
+                        self._albums[owner_id] = {int(album_id): title for album_id, title in cached[str(owner_id)].items()}
+                missing = [owner_id for owner_id in missing if owner_id not in self._albums]
+
+        # несколько потоков фото одного владельца ждут один и тот же запрос
+        tasks = {}
+        for owner_id in missing:
+            task = self._albums_pending.get(owner_id)
+            if task is None:
+                task = self._albums_pending[owner_id] = asyncio.ensure_future(self._fetch_albums(owner_id))
+                task.add_done_callback(lambda _, owner_id=owner_id: self._albums_pending.pop(owner_id, None))
+            tasks[owner_id] = task
+        fetched = dict(zip(tasks, await asyncio.gather(*tasks.values())))
+        for owner_id, albums in fetched.items():
+            self._albums[owner_id] = albums or {}
+            self._albums_refreshed.add(owner_id)
+        fetched = {owner_id: albums for owner_id, albums in fetched.items() if albums is not None}
+        if fetched and self.manifest is not None:
+            self.manifest.cache_put("albums", fetched)
+        return {owner_id: self._albums.get(owner_id, {}) for owner_id in owner_ids}
+
+    async def vk_getAlbums(self, owner_id, refresh: bool = False) -> dict[int, str]:
+        'Альбомы владельца: album_id -> название, см. load_albums'
+        return (await self.load_albums([owner_id], refresh))[owner_id]
+
 class Messages:
     'Основной класс для апи vk.messages'
     def __init__(self, vk):
         self.vk = vk
-
-    def vk_getHistoryAttachments(self, chat_id, types):
-        items = []
-        response = self.vk.messages.getHistoryAttachments(
+        # самое новое сообщение с вложениями при последнем обходе: (chat_id, types) -> message_id
+        self.newest_messages = {}
+
+    @staticmethod
+    def _take_new(items, since_id):
+        'Вложения идут от новых к старым: берем все до первого уже синхронизированного сообщения'
+        for i, item in enumerate(items):
+            if item.get("message_id", 0) <= since_id:
+                return items[:i], True
+        return items, False
+
+    async def iter_history_attachments(self, chat_id, types, since_id=None):
+        '''Вложения переписки постранично, следуя next_from. С since_id обход инкрементальный:
+        останавливаемся на первом вложении из сообщения с message_id не больше since_id'''
+        total = 0
+        response = await self.vk.messages.getHistoryAttachments(
             peer_id = chat_id,
             count=100,
             media_type=types
         )
         #print(response["items"])
-        items.extend(response["items"])
-        while "next_from" in response:
+        page, reached_seen = self._take_new(response["items"], since_id) if since_id is not None else (response["items"], False)
+        if response["items"]:
+            self.newest_messages[(chat_id, types)] = max(item.get("message_id", 0) for item in response["items"])
+        total += len(page)
+        yield page
+        while "next_from" in response and not reached_seen:
             start_from = response.get("next_from")
             logger.info(f"Меняем start_from на {start_from}")
-            response = self.vk.messages.getHistoryAttachments(
+            response = await self.vk.messages.getHistoryAttachments(
                 peer_id = chat_id,
                 count=100,
                 media_type=types,
                 start_from = start_from
             )
-            items.extend(response["items"])
-        logger.info(f"Получили всего {len(items)}")
-
-        return items
+            page, reached_seen = self._take_new(response["items"], since_id) if since_id is not None else (response["items"], False)
+            total += len(page)
+            yield page
+        if reached_seen:
+            logger.info("Дошли до уже синхронизированных сообщений")
+        logger.info(f"Получили всего {total}")
 
 class Utils:
     'Вспомогательный класс для Vkd жизненно важен для основного функционала'
-    def __init__(self, vk, photosClass:Photos, cli_args=None):
+    def __init__(self, vk, photosClass:Photos, cli_args=None, manifest: Manifest = None, id_cache_ttl: float = ID_CACHE_TTL):
         self.vk = vk
         self.photosClass = photosClass
         self.cli_args = cli_args # Сохраняем args
         self.ids_type = ''
-
-    def vk_resolve_ids(self, input_str):
-        ids = input_str.split(",")
-        result = []
-
+        # пользователи, группы, беседы и короткие имена: в памяти на запуск и в манифесте на id_cache_ttl секунд
+        self.manifest = manifest
+        self.id_cache_ttl = id_cache_ttl
+        self._id_cache = {}
+
+    async def _cached_batch(self, kind: str, ids, fetch_batch, batch_size: int, miss_errors=()) -> dict:
+        '''Записи для ids из памяти, потом из кеша в манифесте, остальные одним запросом на batch_size id.
+        fetch_batch(chunk) возвращает {id: запись} для найденных id. Не найденные запоминаются (как None)
+        только в памяти этого запуска, в манифест попадают только найденные.
+        Ошибки апи, не связанные с неверным id (токен, внутренняя ошибка, троттлинг), поднимаются дальше,
+        кроме кодов из miss_errors: с ними вся пачка считается не найденной'''
+        ids = list(dict.fromkeys(ids))
+        known = self._id_cache.setdefault(kind, {})
+        missing = [i for i in ids if i not in known]
+        if missing and self.manifest is not None:
+            cached = self.manifest.cache_get(kind, missing, self.id_cache_ttl)
+            known.update((i, cached[str(i)]) for i in missing if str(i) in cached)
+            missing = [i for i in missing if i not in known]
+        if missing:
+            async def fetch_chunk(chunk):
+                try:
+                    result = await fetch_batch(chunk)
+                    return {i: result.get(i) for i in chunk}
+                except VkApiError as e:
+                    if e.code in miss_errors:
+                        logger.debug(f"{kind}: {e.error_msg}, считаем не найденными {len(chunk)} id")
+                        return dict.fromkeys(chunk)
+                    if e.code not in INVALID_ID_ERRORS:
+                        raise
+                    if len(chunk) == 1:
+                        logger.debug(f"{kind} {chunk[0]} не найден: {e.error_msg}")
+                        return {chunk[0]: None}
+                    # один неверный id валит весь запрос: делим пачку пополам, пока не найдем его
+                    half = len(chunk) // 2
+                    results = await asyncio.gather(fetch_chunk(chunk[:half]), fetch_chunk(chunk[half:]))
+                    return {key: value for result in results for key, value in result.items()}
+
+            chunks = [missing[i:i + batch_size] for i in range(0, len(missing), batch_size)]
+            fetched = {}
+            for result in await asyncio.gather(*(fetch_chunk(chunk) for chunk in chunks)):
+                fetched.update(result)
+            known.update(fetched)
+            found = {i: value for i, value in fetched.items() if value is not None}
+            if found and self.manifest is not None:
+                self.manifest.cache_put(kind, found)
+        return {i: known[i] for i in ids if known.get(i) is not None}
+
+    async def fetch_users(self, user_ids) -> dict:
+        async def fetch_batch(chunk):
+            users = await self.vk.users.get(user_ids=chunk)
+            return {user["id"]: {"first_name": user["first_name"], "last_name": user["last_name"]} for user in users}
+        return await self._cached_batch("user", [int(i) for i in user_ids], fetch_batch, USERS_BATCH)
+
+    async def fetch_groups(self, group_ids) -> dict:
+        'Группы по положительным id'
+        async def fetch_batch(chunk):
+            groups = await self.vk.groups.getById(group_ids=chunk)
+            return {group["id"]: {"name": group["name"]} for group in groups}
+        return await self._cached_batch("group", [abs(int(i)) for i in group_ids], fetch_batch, GROUPS_BATCH)
+
+    async def fetch_conversations(self, peer_ids) -> dict:
+        async def fetch_batch(chunk):
+            response = await self.vk.messages.getConversationsById(peer_ids=chunk, extended=True)
+            names = {group["id"]: group["name"] for group in response.get("groups", [])}
+            names.update({user["id"]: f"{user['first_name']} {user['last_name']}" for user in response.get("profiles", [])})
+            conversations = {}
+            for item in response.get("items", []):
+                peer = item["peer"]
+                title = item.get("chat_settings", {}).get("title") or names.get(abs(peer["id"]))
+                conversations[peer["id"]] = {"type": peer.get("type"), "title": title}
+            return conversations
+        return await self._cached_batch("conversation", [int(i) for i in peer_ids], fetch_batch, CONVERSATIONS_BATCH,
+                                        miss_errors=ACCESS_ERRORS)
+
+    async def resolve_screen_names(self, names) -> dict:
+        async def fetch_batch(chunk):
+            # у utils.resolveScreenName нет списочной формы, одновременные вызовы склеиваются в execute
+            resolved = await asyncio.gather(*(self.vk.utils.resolveScreenName(screen_name=name) for name in chunk))
+            return {
+                name: {"object_id": item["object_id"], "type": item["type"]}
+                # не найденное имя апи отдает пустым списком
+                for name, item in zip(chunk, resolved) if isinstance(item, dict) and item.get("object_id")
+            }
+        return await self._cached_batch("screen_name", names, fetch_batch, EXECUTE_BATCH_SIZE)
+
+    async def vk_resolve_ids(self, input_str):
+        '''Разбирает список целей через запятую. Сначала все цели разбираются локально,
+        потом каждый вид проверки идет одним запросом на всю пачку id и кешируется'''
         chat_pattern = re.compile(r"vk\.com/im/convo/(-?\d+)")
         screen_name_pattern = re.compile(r"vk\.com/([\w\d_.]+)")
 
-        for item in ids:
+        parsed = []
+        for item in input_str.split(","):
             item = item.strip()
             if not item:
                 continue
-
             # Если это ссылка на чат
             chat_match = chat_pattern.search(item)
             if chat_match:
-                chat_id = int(chat_match.group(1))
-                self.ids_type = 'chat'
-                result.append(chat_id)
-                continue
+                parsed.append(("chat", int(chat_match.group(1))))
+            elif re.fullmatch(r"-?\d+", item):
+                parsed.append(("number", int(item)))
             else:
-                logger.info("Это не ссылка на чат")
+                # Если это обычная ссылка вида vk.com/username её мы попробуем отрезовлить через апи
+                screen_name_match = screen_name_pattern.search(item)
+                parsed.append(("name", screen_name_match.group(1) if screen_name_match else item))
+
+        numbers = [value for kind, value in parsed if kind == "number"]
+        # с --chat любое число сначала проверяется как чат, иначе только положительные (большие id чатов)
+        chat_flag = bool(self.cli_args and self.cli_args.chat)
+        conversations = await self.fetch_conversations([n for n in numbers if chat_flag or n > 0])
+        users = await self.fetch_users([n for n in numbers if n > 0 and n not in conversations])
+        groups = await self.fetch_groups([n for n in numbers if n < 0 and n not in conversations])
+        unresolved = [
+            str(value) if kind == "number" else value
+            for kind, value in parsed
+            if kind == "name" or (kind == "number" and value not in conversations and value not in users and abs(value) not in groups)
+        ]
+        screen_names = await self.resolve_screen_names(unresolved)
 
-            is_numeric_string = re.fullmatch(r"-?\d+", item)
-
-            logger.debug(f"cli_args check = {self.cli_args}")
-            # доп проверка чата
-            if self.cli_args and self.cli_args.chat:
-                if is_numeric_string and self.check_chat_id(item):
-                    self.ids_type = 'chat'
-                    result.append(int(item))
-                    logger.debug(f"ID '{int(item)}' распознан как 'chat'.")
-                    continue
-            else:
-                logger.info(f"Не прошли проверку аргумента кли, что это чат {item}")
-            
-            # проверка числового значения: чат/пользователь/группа
-            if is_numeric_string:
-                numeric_item = int(item)
-                if numeric_item < 0:
-                    logger.info(f"Это число с минусом{item}")
-                    if self.check_group_id(item):
-                        self.ids_type = 'group'
-                        result.append(numeric_item)
-                        logger.debug(f"ID '{numeric_item}' распознан как 'group'.")
-                        continue
-                else:
-                    if self.check_chat_id(str(numeric_item)): # Для больших положительных ID чатов
-                        self.ids_type = 'chat'
-                        result.append(numeric_item)
-                        logger.debug(f"ID '{numeric_item}' распознан как 'chat'.")
-                        continue
-                    elif self.check_user_id(str(numeric_item)):
-                        self.ids_type = 'user'
-                        result.append(numeric_item)
-                        logger.debug(f"ID '{numeric_item}' распознан как 'user'.")
-                        continue
-
-            # Если это обычная ссылка вида vk.com/username её мы попробуем отрезовлить ниже
-            screen_name_match = screen_name_pattern.search(item)
-            if screen_name_match:
-                item = screen_name_match.group(1)
+        result = []
+        for kind, value in parsed:
+            if kind == "chat":
+                self.ids_type = 'chat'
+                result.append(value)
+            elif kind == "number" and value in conversations:
+                self.ids_type = 'chat'
+                result.append(value)
+            elif kind == "number" and value > 0 and value in users:
+                self.ids_type = 'user'
+                result.append(value)
+            elif kind == "number" and value < 0 and abs(value) in groups:
+                self.ids_type = 'group'
+                result.append(value)
+            elif str(value) in screen_names:
+                resolved = screen_names[str(value)]
+                object_id = -resolved["object_id"] if resolved["type"] == "group" else resolved["object_id"]
+                self.ids_type = resolved["type"]
+                result.append(object_id)
             else:
-                logger.info("Это не обычная ссылка на группу или пользователя")
-
-            # Пробуем обычный resolve через API
-            try:
-                resolved = self.vk.utils.resolveScreenName(screen_name=item)
-                if resolved and resolved.get("object_id"):
-                    object_id = resolved["object_id"]
-                    type_ = resolved["type"]
-                    if type_ == "group":
-                        object_id = -object_id
-                    self.ids_type = type_
-                    result.append(object_id)
-                    continue
-            except vk_api.VkApiError as e:
-                logger.error(e)
-            except Exception as e:
-                raise ValueError(f"Ошибка при разрешении '{item}': {e}")
-
-            
+                logger.error(f"Не удалось разрешить '{value}'")
+            logger.debug(f"'{value}' распознан как '{self.ids_type}'")
 
         return result, self.ids_type
     
-    def extract_from_raw_data(self, type, raw_data, owner_id):
-        extracted_items = []
+    def iter_extract(self, type, raw_data, albums_dict=None):
+        '''Генератор компактных MediaItem из сырой страницы апи. Нужные поля достаются по одному элементу,
+        так что сырой json страницы можно отпустить сразу после обхода, а не держать рядом с результатом'''
         if type == 'photos':
-            logger.info(f"Пробуем достать фото из items c типом {type}")
-            albums_dict = self.photosClass.vk_getAlbums(owner_id)
             for photo in raw_data:
-                album_id = photo.get("album_id")
-                album_title = albums_dict.get(album_id, "Без альбома")
-                
-                extracted_items.append({
-                    "id": photo.get("id"),
-                    "owner_id": photo.get("owner_id"),
-                    "url": photo.get("sizes", [{}])[-1].get("url") if photo.get("sizes") else None,
-                    "date": datetime.fromtimestamp(int(photo.get("date"))).strftime('%Y-%m-%d %H-%M-%S'),
-                    "album_id": album_id,
-                    "album_title": album_title
-                })
-            return extracted_items
-        
+                yield MediaItem.from_photo(photo, albums_dict if albums_dict is not None else {})
+
         elif type == 'videos':
-            logger.info(f"Пробуем достать видео из items c типом {type}")
             for video in raw_data:
                 if "player" in video:
-                    extracted_items.append({
-                        "type": video.get("type"),
-                        "id": video.get("id"),
-                        "owner_id": video.get("owner_id"),
-                        "title": video.get("title"),
-                        "player": video.get("player"),
-                        "date": datetime.fromtimestamp(int(video.get("date"))).strftime('%Y-%m-%d %H-%M-%S')
-                    })
-            return extracted_items
-        
+                    yield MediaItem.from_video(video)
+
         elif type == 'chat':
-            logger.info(f"Пробуем достать данные из items c типом {type}")
             for item in raw_data:
-                attachment = item.get("attachment", {})
-                if attachment.get("photo", {}):
-                    photo_data = attachment.get("photo", {})
-                    #logger.info(photo_data)
-                    sizes = photo_data.get("sizes", [])
-                    logger.debug(f'"id": {photo_data.get("id")},\n"owner_id": {photo_data.get("owner_id")},\n"url": {sizes[-1].get("url") if sizes and isinstance(sizes[-1], dict) else None},\n"date": {datetime.fromtimestamp(int(photo_data.get("date", 0))).strftime('%Y-%m-%d %H-%M-%S')}')
-                    extracted_items.append({
-                        "id": photo_data.get("id"),
-                        "owner_id": photo_data.get("owner_id"),
-                        "url": sizes[-1].get("url") if sizes and isinstance(sizes[-1], dict) else None,
-                        "date": datetime.fromtimestamp(int(photo_data.get("date", 0))).strftime('%Y-%m-%d %H-%M-%S')
-                    })
-            return extracted_items
-                
-                # --- Видео из чата плохо работают ---
-                # if attachment.get("video", {}):
-                #     video = attachment.get("video", {})
-                #     if "player" in video:
-                #         self.videos.append({
-                #             "type": attachment.get("type"),
-                #             "id": video.get("id"),
-                #             "owner_id": video.get("owner_id"),
-                #             "title": video.get("title"),
-                #             "player": video.get("player"),
-                #             "date": datetime.fromtimestamp(int(video.get("date"))).strftime('%Y-%m-%d %H-%M-%S')
-                #         })
-        
-
-    def check_user_id(self, id: str) -> bool:
-        try:
-            user = self.vk.users.get(user_ids=id)
-            if len(user) != 0:
-                logger.info(f"Пользователь существует {user}") 
-                return True
-            logger.info(f"Пользователь не существует {user}") 
-            return False
-        except Exception as e:
-            logger.error(e)
-            return False
-
-    def check_user_ids(self, ids_list) -> bool:
-        try:
-            logger.info(f"Проверяем, существует ли пользователи с таким id: {ids_list}")
-            for user_id in ids_list: #.split(","):
-                logger.info(f"передаем на проверку id {user_id}")
-                if not self.check_user_id(user_id):
-                    return False
-            return True
-        except Exception as e:
-            logger.error(e)
-            return False
+                photo_data = item.get("attachment", {}).get("photo", {})
+                if photo_data:
+                    yield MediaItem.from_photo(photo_data)
 
-    def check_group_id(self, id: str) -> bool:
-        try:
-            # Проверяем, существует ли группа с таким id
-            group = self.vk.groups.getById(group_id=int(id)*(-1))
-            if len(group) != 0: return True
-            return False
-        except Exception as e:
-            logger.error(e)
-            return False
-
-    def check_group_ids(self, ids_list) -> bool:
-        try:
-            logger.info(f"Проверяем, существует ли группы с таким id: {ids_list}")
-            for group_id in ids_list:#.split(","):
-                logger.info(f"передаем на проверку id {group_id}")
-                if not self.check_group_id(group_id):
-                    return False
-            return True
-        except Exception as e:
-            logger.error(e)
-            return False
-
-    def check_chat_id(self, id: str) -> bool:
-        try:
-            logger.info(f"Проверяем, существует ли беседа с таким id: [{id}]")
-            # Проверяем, существует ли беседа с таким id 2_000_000_000 + 
-            conversation = self.vk.messages.getConversationsById(peer_ids=id)
-            if conversation["count"] != 0: return True
-            return False
-        except Exception as e:
-            logger.error(e)
-            return False
-
-    def get_user_id(self):
-        return self.vk.account.getProfileInfo()["id"]
-
-    def get_username(self, user_id: str):
-        user = self.vk.users.get(user_id=user_id)[0]
+                # --- Видео из чата плохо работают ---
+                # video = item.get("attachment", {}).get("video", {})
+                # if "player" in video:
+                #     yield MediaItem.from_video(video)
+
+    async def check_user_ids(self, ids_list) -> bool:
+        logger.info(f"Проверяем, существует ли пользователи с таким id: {ids_list}")
+        # все id одним запросом, уже проверенные берутся из кеша
+        users = await self.fetch_users(ids_list)
+        return all(int(user_id) in users for user_id in ids_list)
+
+    async def check_group_ids(self, ids_list) -> bool:
+        logger.info(f"Проверяем, существует ли группы с таким id: {ids_list}")
+        groups = await self.fetch_groups(ids_list)
+        return all(abs(int(group_id)) in groups for group_id in ids_list)
+
+    async def check_chat_id(self, id: str) -> bool:
+        logger.info(f"Проверяем, существует ли беседа с таким id: [{id}]")
+        # Проверяем, существует ли беседа с таким id 2_000_000_000 + 
+        return int(id) in await self.fetch_conversations([id])
+
+    async def get_user_id(self):
+        profile = await self.vk.account.getProfileInfo()
+        return profile["id"]
+
+    async def get_username(self, user_id: str):
+        user = (await self.fetch_users([user_id]))[int(user_id)]
         return f"{user['first_name']} {user['last_name']}"
 
-    def get_group_title(self, group_id: str):
-        group_info = self.vk.groups.getById(group_id=int(group_id)*(-1))
-        group_name = group_info[0]["name"].replace("/", " ").replace("|", " ").replace(".", " ").strip()
+    async def get_group_title(self, group_id: str):
+        group = (await self.fetch_groups([group_id]))[abs(int(group_id))]
+        group_name = group["name"].replace("/", " ").replace("|", " ").replace(".", " ").strip()
         return group_name
 
-    def get_chat_title(self, chat_id: str) -> str:
-        try:
-            response = self.vk.messages.getConversationsById(
-                peer_ids=chat_id,
-                extended = True
-            )
-            chat_title = response["groups"][0]["name"]
-        except Exception as e:
-            raise e
-        return chat_title
+    async def get_chat_title(self, chat_id: str) -> str:
+        conversation = (await self.fetch_conversations([chat_id]))[int(chat_id)]
+        return conversation["title"]
     
     def create_dir(self, dir_path: Path):
         if not dir_path.exists():
             dir_path.mkdir(parents=True, exist_ok=True)
 
-async def download_photo(session: aiohttp.ClientSession, photo_url: str, photo_path: Path):
+async def download_photo(session: aiohttp.ClientSession, photo_url: str, photo_path: Path,
+                         store: ContentStore = None) -> dict | None:
     try:
-        if not photo_path.exists():
-            async with session.get(photo_url) as response:
-                if response.status == 200:
-                    async with aiofiles.open(photo_path, "wb") as f:
-                        await f.write(await response.read())
+        # через .part с атомарным переименованием, прерванные загрузки докачиваются
+        return await download_file(session, photo_url, photo_path, store)
     except Exception as e:
         logger.error(e)
+        return None
+
+class PhotoDownloader:
+    '''Потребитель конвейера загрузки фото. Страницы от обхода апи кладутся через add() сразу,
+    загрузка идет параллельно с обходом. Очередь ограничена: когда она полна, add() ждет,
+    и обход не убегает далеко вперед загрузки'''
+    def __init__(self, utils_instance: Utils, workers: int = DOWNLOAD_WORKERS, per_host: int = CONNECTIONS_PER_HOST,
+                 manifest: Manifest = None, store: ContentStore = None):
+        self.utils = utils_instance
+        self.workers = workers
+        self.per_host = per_host
+        self.manifest = manifest
+        self.store = store
+        self.queued = 0
+        self.skipped = 0
+        self.duplicates = 0
+        self.copied = 0
+        self._done = {}
+        self._done_owners = set()
+        # папки целей этого запуска: упавшие раньше загрузки в них повторяются, даже если обход их не встретил
+        self.targets = set()
+        # одно и то же фото приходит из нескольких списков (saved, profile, wall, getAll, стена) и от нескольких
+        # целей (репосты): по сети оно проходит один раз, а в папку каждой цели попадает своя копия или ссылка
+        self._keys_by_url = {}
+        self._seen_in_target = set()
+        self._queued_paths = {}
+        self._finished = {}
+        self._waiting = {}
+
+    async def __aenter__(self):
+        self.time_start = time.time()
+        self.session = make_session(self.workers, self.per_host)
+        self.progress = tqdm(total=0)
+        # фиксированное число воркеров и потоковая запись: память и сокеты не растут с размером задания
+        self.pool = DownloadPool(self._handle, self.workers, progress=self.progress)
+        await self.pool.__aenter__()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                await self._retry_failed()
+            await self.pool.__aexit__(exc_type, exc, tb)
+        finally:
+            self.progress.close()
+            await self.session.close()
+
+        download_time = math.ceil(time.time() - self.time_start)
+        logger.info(f"Уже скачано по манифесту: {self.skipped}, повторов из разных списков: {self.duplicates}, "
+                    f"скопировано из папок других целей: {self.copied}")
+        logger.info("{} {} за {}".format(
+            numeral.choose_plural(self.queued, "Скачена, Скачены, Скачены"),
+            numeral.get_plural(self.queued, "фотография, фотографии, фотографий"),
+            numeral.get_plural(download_time, "секунду, секунды, секунд")
+        ))
 
-async def download_photos(utils_instance:Utils, photos_path: Path, photos: list):
-    logger.info("{} {} {}".format(
-        numeral.choose_plural(len(photos), "Будет, Будут, Будут"),
-        numeral.choose_plural(len(photos), "скачена, скачены, скачены"),
-        numeral.get_plural(len(photos), "фотография, фотографии, фотографий")
-    ))
-    #print(photos)
-    time_start = time.time()
-
-    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None)) as session:
-        futures = []
-        for i, photo in enumerate(photos, start=1):
-            if photo.get("album_title"):
-                logger.debug(f"у нас есть тайтл для фото {photo.get("album_title")}")
-                album_dir = (photos_path / safe_filename(photo["album_title"])).resolve()
-                utils_instance.create_dir(album_dir)
-                logger.debug(f"Создана директория {album_dir}")
-                photo_title = f"{photo['date']}_{photo['owner_id']}_{photo['id']}.jpg"
-                full_path = (album_dir / photo_title).resolve()
-            else:
-                logger.debug(f"ветка иначе")
-                full_path = (photos_path / f"{photo['date']}_{photo['owner_id']}_{photo['id']}.jpg").resolve()
-                logger.debug(f"ветка путь {full_path}")
-
-            if full_path.exists():
-                logger.info(f"Пропущено (уже существует): {full_path.name}")
+    def _done_path(self, photo) -> Path | None:
+        'Куда фото было скачано в прошлых запусках, None если не скачивалось'
+        if self.manifest is None:
+            return None
+        owner_id = photo["owner_id"]
+        if owner_id not in self._done_owners:
+            # что уже скачано, узнаем одним запросом к манифесту на владельца, без проверки каждого файла на диске
+            self._done.update(self.manifest.done_paths("photo", [owner_id]))
+            self._done_owners.add(owner_id)
+        path = self._done.get((owner_id, photo["id"]))
+        return Path(path) if path else None
+
+    def _key(self, photo) -> tuple:
+        'Одно и то же фото: тот же (owner_id, id) или тот же путь в url'
+        key = (photo["owner_id"], photo["id"])
+        return self._keys_by_url.setdefault(urlsplit(photo["url"]).path, key)
+
+    def _place(self, source: Path, target: Path):
+        'Копия уже скачанного фото в папке другой цели: ссылка на объект хранилища или обычная копия'
+        if self.store is not None:
+            self.store.link(source, target)
+            return
+        tmp = target.with_name(target.name + ".part")
+        shutil.copy2(source, tmp)
+        os.replace(tmp, target)
+
+    async def _copy(self, source: Path, target: Path) -> bool:
+        if target.exists():
+            return True
+        try:
+            await asyncio.to_thread(self._place, source, target)
+        except OSError as e:
+            logger.error(f"Не удалось скопировать {source} в {target}: {e}")
+            return False
+        self.copied += 1
+        return True
+
+    def photo_path(self, photos_path: Path, photo: dict) -> Path:
+        if photo.get("album_title"):
+            logger.debug(f"у нас есть тайтл для фото {photo.get("album_title")}")
+            album_dir = (photos_path / safe_filename(photo["album_title"])).resolve()
+            self.utils.create_dir(album_dir)
+            logger.debug(f"Создана директория {album_dir}")
+            photo_title = f"{photo['date']}_{photo['owner_id']}_{photo['id']}.jpg"
+            return (album_dir / photo_title).resolve()
+        logger.debug(f"ветка иначе")
+        full_path = (photos_path / f"{photo['date']}_{photo['owner_id']}_{photo['id']}.jpg").resolve()
+        logger.debug(f"ветка путь {full_path}")
+        return full_path
+
+    async def add(self, photos_path: Path, photos) -> int:
+        'Кладет в очередь загрузки фото одной страницы (список или генератор), возвращает, сколько фото в ней было'
+        count = 0
+        target = photos_path.resolve()
+        for photo in photos:
+            count += 1
+            if not photo.get("url"):
+                logger.warning(f"Пропуск фото без url: {photo['owner_id']}_{photo['id']}")
                 continue
-            futures.append(download_photo(session, photo["url"], full_path))
-
-        for future in tqdm(asyncio.as_completed(futures), total=len(futures)):
-            try:
-                await future
-            except Exception as e:
-                logger.error('Got an exception: %s' % e)
-
-    time_finish = time.time()
-    download_time = math.ceil(time_finish - time_start)
-    logger.info("{} {} за {}".format(
-        numeral.choose_plural(len(photos), "Скачена, Скачены, Скачены"),
-        numeral.get_plural(len(photos), "фотография, фотографии, фотографий"),
-        numeral.get_plural(download_time, "секунду, секунды, секунд")
-    ))
-
-async def download_video(video_path:Path, video_link, proxy_url=None):
-
-    ydl_opts = {
-        'outtmpl': '{}'.format(video_path), 
-        'quiet': True, 
-        #'verbose': True,
-        'retries': 3, 
-        'ignoreerrors': True, 
-        'age_limit': 28,
-    }
-    if proxy_url:
-        ydl_opts['proxy'] = proxy_url # Добавляем прокси если он указан
+            key = self._key(photo)
+            # в пределах одной цели фото одно, в какой бы из списков оно ни попало
+            if (target, key) in self._seen_in_target:
+                self.duplicates += 1
+                continue
+            self._seen_in_target.add((target, key))
+            if key in self._queued_paths:
+                # в этом запуске фото уже качается для другой цели: копия появится, когда загрузка закончится
+                full_path = self.photo_path(photos_path, photo)
+                if key not in self._finished:
+                    self._waiting.setdefault(key, []).append(full_path)
+                    continue
+                if self._finished[key] is not None and await self._copy(self._finished[key], full_path):
+                    continue
+                # первая загрузка не удалась: качаем для этой цели отдельно
+                await self._put((photo, full_path))
+                continue
+            done_path = self._done_path(photo)
+            if done_path is not None:
+                # в прошлый раз скачано в эту же цель (в каком бы из списков и папок оно ни было)
+                if done_path.is_relative_to(target):
+                    self.skipped += 1
+                    continue
+                # скачано для другой цели: копируем оттуда, не качая заново
+                full_path = self.photo_path(photos_path, photo)
+                if done_path.exists() and await self._copy(done_path, full_path):
+                    self.skipped += 1
+                    continue
+            else:
+                full_path = self.photo_path(photos_path, photo)
+            self._queued_paths[key] = full_path
+            # существующие файлы тоже отдаем загрузчику: он сверит размер и докачает обрезанные
+            await self._put((photo, full_path))
+        return count
+
+    async def _put(self, job):
+        self.queued += 1
+        self.progress.total = self.queued
+        self.progress.refresh()
+        await self.pool.put(job)
+
+    def add_target(self, d_dir: Path):
+        self.targets.add(d_dir)
+
+    async def _retry_failed(self):
+        '''Упавшие в прошлых запусках загрузки в папки целей этого запуска, которых не было в обходе.
+        Считаются по папке цели, а не по владельцу фото: инкрементальный обход стены или чата
+        останавливается на водяном знаке и может не встретить ни одного фото того же владельца'''
+        if self.manifest is None or not self.targets:
+            return
+        for item in self.manifest.failed_items("photo", directories=self.targets):
+            if item["url"] and item["path"] and self._key(item) not in self._queued_paths:
+                await self._put((item, Path(item["path"])))
+
+    async def _handle(self, job):
+        photo, full_path = job
+        result = await download_photo(self.session, photo["url"], full_path, self.store)
+        key = self._key(photo)
+        self._finished[key] = full_path if result else None
+        # копии для других целей, которые дождались этой загрузки
+        for path in self._waiting.pop(key, []):
+            if not (result and await self._copy(full_path, path)):
+                await download_photo(self.session, photo["url"], path, self.store)
+        if self.manifest is None:
+            return
+        if result:
+            self.manifest.mark_done(photo["owner_id"], "photo", photo["id"], photo["url"], full_path, result["size"], result["sha1"])
+        else:
+            self.manifest.mark_failed(photo["owner_id"], "photo", photo["id"], photo["url"], full_path)
 
+async def make_proxy_pool(cli_args, probe_url: str = PROBE_URL, ttl: float = PROXY_TTL) -> ProxyPool | None:
+    'Проверенный пул прокси для yt-dlp, если он запрошен флагом --use-proxy'
+    if not cli_args.use_proxy:
+        return None
+    #пробуем получить прокси для yt-dlp
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download(video_link)
-            logger.info("Видео загружено: %s" % video_path.name)
-    except yt_dlp.utils.DownloadError as e:
-        logger.error(f"Ошибка загрузки yt-dlp для {video_link} в {video_path}: {e}")
+        proxy_pool = await build_proxy_pool(PROXY_PATH, probe_url, ttl)
     except Exception as e:
-        logger.error(f"Неожиданная ошибка при загрузке видео {video_link} в {video_path}: {e}")
-
-async def download_videos(videos_path: Path, videos: list, cli_args):
-    proxy_str = None
-    if cli_args.use_proxy:
-        #пробуем получить прокси для yt-dlp
-        try:
-            if not PROXY_PATH.exists():
-                yt_dlp_proxy.update_proxies()
-            with open("proxy.json", "r") as f:
-                proxy = random.choice(json.load(f))
-                proxy_str = construct_proxy_string(proxy)
-                logger.info(f"Using proxy from {proxy['city']}, {proxy['country']}")
-        except Exception as e:
-            logger.error("Ошибка при получении прокси", e)
-
+        logger.error(f"Ошибка при получении прокси: {e}")
+        return None
+    if not proxy_pool.healthy:
+        logger.error("Нет ни одного живого прокси, видео качаются без прокси")
+        return None
+    return proxy_pool
+
+async def download_videos(videos_path: Path, videos: list, cli_args, manifest: Manifest = None, pool: VideoPool = None):
+    if pool is None:
+        async with VideoPool(VIDEO_WORKERS, await make_proxy_pool(cli_args)) as pool:
+            return await download_videos(videos_path, videos, cli_args, manifest, pool)
+
+    done = manifest.done_paths("video", {video["owner_id"] for video in videos}) if manifest else {}
     futures = []
     for i, video in enumerate(videos, start=1):
         filename = "{}_{}_{}.mp4".format(video["date"], video["owner_id"], video["id"])
@@ -802,17 +1035,31 @@ async def download_videos(videos_path: Path, videos: list, cli_args):
         if not video_path:
             logger.error("Не может быть создан путь для видео", video_path)
             continue
+        if done.get((video["owner_id"], video["id"])) == str(video_path):
+            continue
         if video_path.exists():
             logger.debug(f"Пропущено (уже существует): {video_path.name}")
+            if manifest:
+                manifest.mark_done(video["owner_id"], "video", video["id"], video["player"], video_path, video_path.stat().st_size)
             continue
-        futures.append(download_video(video_path, video["player"], proxy_str))
+        futures.append(download_tracked_video(video, video_path, pool, manifest))
     logger.info("Мы попробуем скачать %s видео" % len(futures))
-    for future in tqdm(asyncio.as_completed(futures), total=len(futures)):
+    # все видео сразу уходят в пул, одновременно качается столько, сколько в нем потоков
+    for future in asyncio.as_completed(futures):
         try:
             await future
         except Exception as e:
             logger.error('Исключение при загрузке видео: %s' % e)
 
+async def download_tracked_video(video: dict, video_path: Path, pool: VideoPool, manifest: Manifest = None):
+    'Загрузка видео с записью результата в манифест'
+    ok = await pool.download(video_path, video["player"], video.get("files"))
+    if manifest is None:
+        return
+    if ok:
+        manifest.mark_done(video["owner_id"], "video", video["id"], video["player"], video_path, video_path.stat().st_size)
+    else:
+        manifest.mark_failed(video["owner_id"], "video", video["id"], video["player"], video_path)
 
 if __name__ == '__main__':
     try:
@@ -853,6 +1100,14 @@ if __name__ == '__main__':
                             action="store_true",
                             help="Использовать прокси для скачивания видео")
         
+        parser.add_argument("-i","--incremental",
+                            action="store_true",
+                            help="Обходить стену и переписку только до уже синхронизированных постов и сообщений.")
+
+        parser.add_argument("-s","--content-store",
+                            action="store_true",
+                            help="Хранить одинаковые фото один раз (по хешу содержимого), в папки ставить жесткие ссылки.")
+
         parser.add_argument("-a","--audio",
                             action="store_true",
                             help="Скачать аудиозаписи (в зависимости от типа vk_ids).")